@@ -0,0 +1,281 @@
+"""Replay a captured traffic log against the webhook, with stubbed upstreams.
+
+    python -m bench.replay traffic.jsonl                 # as recorded (1x)
+    python -m bench.replay traffic.jsonl --speed 10
+    python -m bench.replay traffic.jsonl --speed max --workers 4 \\
+        --geocode-latency lognormal:-2.3,0.5 --redis-latency const:0.001
+
+Logs come from setting TRAFFIC_CAPTURE_PATH on the app (see traffic.py).
+Requests go through maps.app's test client, from --workers processes
+standing in for gunicorn's sync workers: each is forked after the stubs
+are installed, so has its own caches and Redis connections, like the real
+thing. Without a redis-server (see --redis-url and --redis-server) there's
+only FakeRedis, which can't be shared, so the workers are threads in one
+process instead; the report says so, as those numbers are GIL-bound.
+Each upstream's latency is drawn from the distribution given for it, in
+seconds:
+
+    const:S          always S
+    uniform:A,B      anywhere from A to B
+    normal:MU,SD     gaussian, clipped at zero
+    lognormal:MU,SD  exp() of a gaussian; a good fit for network calls
+    exp:MEAN         exponential
+
+Latency is measured from when the request was due, so at 1x or 10x time
+spent waiting for a free worker counts against it.
+
+Queued jobs (sending directions pages and the like) are run by
+--job-workers processes (or threads) standing in for rq workers, taking from the high,
+default and low queues in that order. Their latency is from enqueue to
+finishing, so it includes the Twilio sends.
+"""
+import argparse
+import multiprocessing
+import Queue
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from bench import stubs
+
+import maps
+import traffic
+from worker import listen
+
+
+COMMAND_TYPES = {
+    maps._handle_location: 'location',
+    maps._handle_navigation: 'pan',
+    maps._handle_destination: 'directions',
+    maps._handle_next: 'next',
+    maps._handle_preset: 'preset',
+    maps._handle_help: 'help',
+}
+
+DISTRIBUTIONS = {
+    'const': lambda s: lambda: s,
+    'uniform': lambda a, b: lambda: random.uniform(a, b),
+    'normal': lambda mu, sd: lambda: max(0.0, random.gauss(mu, sd)),
+    'lognormal': lambda mu, sd: lambda: random.lognormvariate(mu, sd),
+    'exp': lambda mean: lambda: random.expovariate(1.0 / mean),
+}
+
+
+def latency(spec):
+    """Parse a latency distribution like 'uniform:0.05,0.2' into a sampler."""
+    name, _, params = spec.partition(':')
+    if name not in DISTRIBUTIONS:
+        raise argparse.ArgumentTypeError("unknown distribution {!r}".format(name))
+    try:
+        return DISTRIBUTIONS[name](*[float(p) for p in params.split(',') if p])
+    except (TypeError, ValueError):
+        raise argparse.ArgumentTypeError("bad latency {!r}".format(spec))
+
+
+def speed(value):
+    if value == 'max':
+        return None
+    return float(value.rstrip('x'))
+
+
+def command_type(body):
+    handler, _ = maps.router.route(body)
+    return COMMAND_TYPES.get(handler, handler.__name__)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, int(round(fraction * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+def replay(records, queues, speed=1.0, workers=8, job_workers=1, processes=True):
+    """Post `records` to maps.app, paced by their timestamps.
+
+    `queues` are the stub rq queues, by name, whose jobs are run as they
+    come in; with `processes`, they have to be RedisQueues. `speed` of
+    None sends as fast as the workers can take them. Returns ({command
+    type: [latencies]}, error count, elapsed seconds, {queue: [job
+    latencies]}, failed job count); elapsed runs until the last request
+    is answered, not until the queues drain.
+    """
+    if processes:
+        Worker, Channel, Event = multiprocessing.Process, multiprocessing.Queue, multiprocessing.Event
+    else:
+        Worker, Channel, Event = threading.Thread, Queue.Queue, threading.Event
+    pending = Channel(maxsize=workers * 2)
+    # Each worker puts one ({name: [latencies]}, error count) here when done.
+    results = Channel()
+    requests_done = Event()
+
+    def work():
+        latencies = defaultdict(list)
+        errors = 0
+        client = maps.app.test_client()
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            due, record = item
+            if due is None:
+                due = time.time()
+            response = client.post('/', data={'From': record['from'], 'Body': record['body']})
+            done = time.time()
+            if response.status_code >= 500:
+                errors += 1
+            latencies[command_type(record['body'])].append(done - due)
+        results.put((dict(latencies), errors))
+
+    def run_jobs():
+        latencies = defaultdict(list)
+        errors = 0
+        while True:
+            for name in listen:
+                job = queues[name].take()
+                if job is not None:
+                    break
+            else:
+                if requests_done.is_set():
+                    # Nothing queued and nothing more coming, bar what
+                    # jobs still running on other workers will queue.
+                    break
+                time.sleep(0.001)
+                continue
+            func, args, kwargs, enqueued = job
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                errors += 1
+            latencies[name].append(time.time() - enqueued)
+        results.put((dict(latencies), errors))
+
+    def collect(count):
+        latencies = defaultdict(list)
+        errors = 0
+        for _ in xrange(count):
+            worker_latencies, worker_errors = results.get()
+            for name, values in worker_latencies.iteritems():
+                latencies[name].extend(values)
+            errors += worker_errors
+        return latencies, errors
+
+    threads = [Worker(target=work) for _ in xrange(workers)]
+    job_threads = [Worker(target=run_jobs) for _ in xrange(job_workers)]
+    for thread in threads + job_threads:
+        thread.daemon = True
+        thread.start()
+
+    start = time.time()
+    first_ts = records[0]['ts'] if records else 0
+    for record in records:
+        due = None
+        if speed is not None:
+            due = start + (record['ts'] - first_ts) / speed
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        pending.put((due, record))
+
+    for _ in threads:
+        pending.put(None)
+    # Job workers only report once requests_done is set, so these are
+    # all from the request workers. Drain before joining: a process
+    # doesn't exit until what it's put on a queue has been read.
+    latencies, errors = collect(workers)
+    elapsed = time.time() - start
+    requests_done.set()
+    job_latencies, job_errors = collect(job_workers)
+    for thread in threads + job_threads:
+        thread.join()
+    return latencies, errors, elapsed, job_latencies, job_errors
+
+
+def report(latencies, errors, elapsed, job_latencies, job_errors, processes=True):
+    if processes:
+        print 'workers: processes, against redis-server'
+    else:
+        print 'workers: threads in one process, against FakeRedis (GIL-bound)'
+    print
+    print '{:<12} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'command', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s')
+    everything = []
+    for name, values in sorted(latencies.iteritems()):
+        everything.extend(values)
+        _print_row(name, sorted(values), elapsed)
+    _print_row('all', sorted(everything), elapsed)
+    if errors:
+        print '{} request(s) failed'.format(errors)
+
+    if job_latencies or job_errors:
+        print
+        print '{:<12} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+            'queue', 'jobs', 'p50 ms', 'p95 ms', 'p99 ms', 'jobs/s')
+        for name in listen:
+            _print_row(name, sorted(job_latencies.get(name, [])), elapsed)
+        if job_errors:
+            print '{} job(s) failed'.format(job_errors)
+
+
+def _print_row(name, values, elapsed):
+    if not values:
+        return
+    print '{:<12} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+        name,
+        len(values),
+        percentile(values, 0.50) * 1000,
+        percentile(values, 0.95) * 1000,
+        percentile(values, 0.99) * 1000,
+        len(values) / elapsed,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('log', help="a capture log written via TRAFFIC_CAPTURE_PATH")
+    parser.add_argument('--speed', type=speed, default=1.0,
+                        help="replay rate, e.g. 1, 10 or max (default: 1)")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="concurrent requests, as gunicorn workers (default: %(default)s)")
+    parser.add_argument('--redis-url', help="a scratch Redis to use; it gets flushed")
+    parser.add_argument('--redis-server', metavar='PATH',
+                        help="redis-server to start for the run (default: the one on PATH)")
+    parser.add_argument('--job-workers', type=int, default=1,
+                        help="workers running queued jobs, as rq workers (default: %(default)s)")
+    parser.add_argument('--fixture', default='directions_short.json',
+                        help="Directions API response to answer with (default: %(default)s)")
+    for service, default in [('redis', 'const:0.0005'),
+                             ('geocode', 'lognormal:-2.3,0.4'),
+                             ('directions', 'lognormal:-1.6,0.4'),
+                             ('twilio', 'lognormal:-2.0,0.3'),
+                             ('queue', 'const:0.0005')]:
+        parser.add_argument('--{}-latency'.format(service), type=latency,
+                            default=latency(default), metavar='DIST',
+                            help="(default: {})".format(default))
+    args = parser.parse_args(argv)
+
+    records = traffic.read_log(args.log)
+    with stubs.scratch_redis(args.redis_url, args.redis_server) as redis_client:
+        processes = redis_client is not None
+        stubs_ = stubs.install(
+            redis_client,
+            redis_latency=args.redis_latency,
+            geocode_latency=args.geocode_latency,
+            directions_latency=args.directions_latency,
+            twilio_latency=args.twilio_latency,
+            queue_latency=args.queue_latency,
+            directions_fixture=args.fixture,
+            shared_queues=processes,
+        )
+        try:
+            results = replay(records, stubs_.queues, args.speed, args.workers,
+                             args.job_workers, processes)
+            report(*results, processes=processes)
+        finally:
+            stubs.uninstall()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+"""Microbenchmarks for the webhook hot path.
+
+    python -m bench.run                           # print results
+    python -m bench.run --save bench/baseline.json
+    python -m bench.run --compare bench/baseline.json --threshold 0.15
+
+Runs offline: rq, the geocoder, the Directions API and Twilio are all
+replaced by the stand-ins in bench.stubs. Redis is a throwaway
+redis-server (--redis-server, or the one on PATH) or --redis-url, and
+FakeRedis only if there's neither. With --compare, exits non-zero if any
+benchmark's ops/sec dropped by more than the threshold.
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+import timeit
+
+from bench import stubs
+
+import directions
+import maps
+
+
+BENCHMARKS = []
+
+# The scratch Redis main() found, or None for FakeRedis.
+redis_client = None
+
+
+def benchmark(name):
+    """Register a setup function returning the zero-argument callable to time."""
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+@benchmark('twiml.toxml.small')
+def _toxml_small():
+    response = maps._error_response(u"Please enter a location to start from!")
+    return response.toxml
+
+
+@benchmark('twiml.toxml.large')
+def _toxml_large():
+    return maps._get_tcon_response(maps.TConDirections.HOTEL).toxml
+
+
+@benchmark('twiml.toxml_etree.large')
+def _toxml_etree_large():
+    return maps._get_tcon_response(maps.TConDirections.HOTEL).toxml_etree
+
+
+@benchmark('twiml.build_and_render.map')
+def _render_map():
+    location = dict(lat='37.7819', lon='-122.3973', zoom='15')
+    return lambda: unicode(maps._build_map_response(location))
+
+
+@benchmark('directions.strip_tags')
+def _strip_tags():
+    html = (u'Turn <b>left</b> onto <b>Harrison St</b>'
+            u'<div style="font-size:0.9em">Pass by Walgreens &amp; Co (on the left)</div>')
+    return lambda: directions.strip_tags(html)
+
+
+@benchmark('directions.heading')
+def _heading():
+    start = {'lat': 37.7819464, 'lng': -122.3972657}
+    end = {'lat': 37.7851343, 'lng': -122.3972406}
+    return lambda: directions.heading(start, end)
+
+
+def _fetch_steps(fixture):
+    def setup():
+        stubs.install(redis_client, directions_fixture=fixture)
+        return lambda: maps._fetch_steps(u'645 Harrison St', u'635 8th St')
+    return setup
+
+
+benchmark('maps.get_steps.uncached.short')(_fetch_steps('directions_short.json'))
+benchmark('maps.get_steps.uncached.long')(_fetch_steps('directions_long.json'))
+
+
+@benchmark('maps.get_steps.cached.long')
+def _get_steps_cached():
+    stubs.install(redis_client, directions_fixture='directions_long.json')
+    maps.get_steps(u'645 Harrison St', u'635 8th St')
+    return lambda: maps.get_steps(u'645 Harrison St', u'635 8th St')
+
+
+@benchmark('router.route')
+def _route():
+    bodies = [u'food', u'North', u'next', u'To: 635 8th St', u'help',
+              u'645 Harrison Street, San Francisco, CA']
+
+    def route():
+        for body in bodies:
+            maps.router.route(body)
+    return route
+
+
+@benchmark('maps.apply_movement')
+def _apply_movement():
+    location = dict(lat='37.7819', lon='-122.3973', zoom='15')
+    return lambda: maps._apply_movement(location, maps.Directions.NORTH)
+
+
+@benchmark('maps.apply_movement.tile_grid')
+def _apply_tile_movement():
+    location = dict(lat='37.775057', lon='-122.404175', zoom='15')
+    return lambda: maps._apply_tile_movement(location, maps.Directions.NORTH)
+
+
+def _webhook(*bodies):
+    """Time posting `bodies` to the webhook, after a location is set."""
+    def setup():
+        stubs_ = stubs.install(redis_client)
+        client = maps.app.test_client()
+        _check(client.post('/', data={'From': '+15555550100', 'Body': u'645 Harrison St'}))
+        for body in bodies:
+            # Fail now rather than time a stream of error pages.
+            _check(client.post('/', data={'From': '+15555550100', 'Body': body}))
+
+        def post():
+            for body in bodies:
+                client.post('/', data={'From': '+15555550100', 'Body': body})
+            for queue in stubs_.queues.itervalues():
+                del queue.jobs[:]
+        return post
+    return setup
+
+
+def _check(response):
+    if response.status_code != 200:
+        raise RuntimeError("webhook answered {}:\n{}".format(
+            response.status_code, response.data))
+
+
+benchmark('webhook.location')(_webhook(u'645 Harrison St'))
+benchmark('webhook.navigation')(_webhook(u'north'))
+benchmark('webhook.preset')(_webhook(u'food'))
+benchmark('webhook.help')(_webhook(u'help'))
+benchmark('webhook.directions')(_webhook(u'To: 635 8th St', u'next'))
+
+
+def measure(func, min_time=0.2, repeat=3):
+    """Return ops/sec (best of `repeat`) and per-op allocation figures."""
+    number = 1
+    while timeit.timeit(func, number=number) < min_time / 10:
+        number *= 10
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+
+    allocated, peak = _allocations(func)
+    return {
+        'ops_per_sec': number / best,
+        'allocs_per_op': allocated,
+        'peak_objects': peak,
+        'retained_per_op': _retained_per_op(func),
+    }
+
+
+def _allocations(func):
+    """Objects allocated by one call of `func`, and the most alive at once.
+
+    There's no tracemalloc on Python 2, so this follows the cycle
+    collector's generation 0 count, which goes up for every list, dict,
+    instance and the like allocated and down for every one freed, from a
+    profile hook run on each function call and return. Untracked objects
+    (str, int, float) and anything allocated and freed inside a single C
+    call go uncounted, so both figures are lower bounds; they're for
+    comparing runs, not for adding up bytes.
+    """
+    counts = []
+    gc.collect()
+    gc.disable()
+    sys.setprofile(lambda frame, event, arg: counts.append(gc.get_count()[0]))
+    try:
+        func()
+    finally:
+        sys.setprofile(None)
+        gc.enable()
+    if not counts:
+        return 0, 0
+    allocated = sum(max(0, after - before) for before, after in zip(counts, counts[1:]))
+    return allocated, max(counts) - counts[0]
+
+
+def _retained_per_op(func, number=100):
+    # Objects still alive after each call: steady growth means something
+    # on the path is accumulating state.
+    gc.collect()
+    before = len(gc.get_objects())
+    for _ in xrange(number):
+        func()
+    gc.collect()
+    return (len(gc.get_objects()) - before) / float(number)
+
+
+def run(only=None):
+    results = {}
+    for name, setup in BENCHMARKS:
+        if only and not any(pattern in name for pattern in only):
+            continue
+        results[name] = measure(setup())
+        _print_result(name, results[name])
+    return results
+
+
+def _print_result(name, result):
+    print '{:<36} {:>12,.0f} ops/s {:>8,} allocs/op {:>7,} peak {:>6.2f} retained/op'.format(
+        name,
+        result['ops_per_sec'],
+        result['allocs_per_op'],
+        result['peak_objects'],
+        result['retained_per_op'],
+    )
+
+
+def compare(results, baseline, threshold):
+    """Return the names of benchmarks more than `threshold` slower than baseline."""
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        change = result['ops_per_sec'] / previous['ops_per_sec'] - 1
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print '{:<36} {:>+8.1%}{}'.format(name, change, flag)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--save', metavar='PATH', help="write results to a JSON baseline")
+    parser.add_argument('--compare', metavar='PATH', help="compare against a JSON baseline")
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help="allowed fractional slowdown (default: %(default)s)")
+    parser.add_argument('--redis-url', help="a scratch Redis to use; it gets flushed")
+    parser.add_argument('--redis-server', metavar='PATH',
+                        help="redis-server to start for the run (default: the one on PATH)")
+    parser.add_argument('only', nargs='*', help="only run benchmarks whose names contain these")
+    args = parser.parse_args(argv)
+
+    global redis_client
+    with stubs.scratch_redis(args.redis_url, args.redis_server) as redis_client:
+        try:
+            results = run(args.only)
+        finally:
+            stubs.uninstall()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print '{} benchmark(s) regressed by more than {:.0%}'.format(
+                len(regressions), args.threshold)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
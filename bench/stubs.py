@@ -0,0 +1,683 @@
+"""Offline stand-ins for Redis, rq, the geocoder and Google/Twilio HTTP.
+
+Redis is best given for real: a scratch server (its database is flushed),
+or a throwaway redis-server started by scratch_redis(). Failing those,
+FakeRedis keeps data in process and runs Python versions of the app's
+Lua scripts, so the scripts themselves aren't exercised.
+"""
+import fnmatch
+import hashlib
+import json
+import math
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib
+from StringIO import StringIO
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+
+import redis
+
+import cache
+import client
+import fairqueue
+import maps
+import metrics
+import routeblob
+from cache import GeocodeCache
+from cache import RouteCache
+from client import LazyScript
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name)) as f:
+        return f.read()
+
+
+def no_latency():
+    return 0.0
+
+
+class FakeRedis(object):
+    """Just enough of redis.Redis, kept in process memory.
+
+    Values are stored as str, as a real server would return them. Expiry
+    times are recorded but never enforced.
+    """
+
+    def __init__(self, latency=no_latency):
+        self.latency = latency
+        self.data = {}
+        self.ttls = {}
+
+    def _wait(self):
+        delay = self.latency()
+        if delay:
+            time.sleep(delay)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def flushall(self):
+        self.data.clear()
+        self.ttls.clear()
+
+    def register_script(self, source):
+        return FakeScript(self, source)
+
+    def _call(self, _command, *args, **kwargs):
+        # Not `name`: commands like setex take a name= keyword of their own.
+        self._wait()
+        return getattr(self, '_' + _command)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if not hasattr(type(self), '_' + name):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+
+    # Commands.
+
+    def _get(self, name):
+        return self.data.get(name)
+
+    def _set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        if nx and name in self.data:
+            return None
+        if xx and name not in self.data:
+            return None
+        self.data[name] = str(value)
+        if ex is not None:
+            self.ttls[name] = ex
+        return True
+
+    def _setnx(self, name, value):
+        return bool(self._set(name, value, nx=True))
+
+    def _setex(self, name, value, time):
+        self.ttls[name] = time
+        return self._set(name, value)
+
+    def _getrange(self, key, start, end):
+        value = self.data.get(key, '')
+        if end < 0:
+            end = len(value) + end
+        return value[start:end + 1]
+
+    def _strlen(self, name):
+        return len(self.data.get(name, ''))
+
+    def _incr(self, name, amount=1):
+        value = int(self.data.get(name, 0)) + amount
+        self.data[name] = str(value)
+        return value
+
+    def _delete(self, *names):
+        count = 0
+        for name in names:
+            if self.data.pop(name, None) is not None:
+                count += 1
+            self.ttls.pop(name, None)
+        return count
+
+    def _exists(self, name):
+        return name in self.data
+
+    def _expire(self, name, time):
+        if name not in self.data:
+            return False
+        self.ttls[name] = time
+        return True
+
+    def _ttl(self, name):
+        return self.ttls.get(name)
+
+    def _keys(self, pattern='*'):
+        return [k for k in self.data if fnmatch.fnmatchcase(k, pattern)]
+
+    def _hgetall(self, name):
+        return dict(self.data.get(name, {}))
+
+    def _hget(self, name, key):
+        return self.data.get(name, {}).get(key)
+
+    def _hmget(self, name, keys):
+        hash_ = self.data.get(name, {})
+        return [hash_.get(key) for key in keys]
+
+    def _hmset(self, name, mapping):
+        hash_ = self.data.setdefault(name, {})
+        for key, value in mapping.iteritems():
+            hash_[key] = value if isinstance(value, basestring) else str(value)
+        return True
+
+    def _hset(self, name, key, value):
+        hash_ = self.data.setdefault(name, {})
+        is_new = key not in hash_
+        hash_[key] = value if isinstance(value, basestring) else str(value)
+        return int(is_new)
+
+    def _hdel(self, name, *keys):
+        hash_ = self.data.get(name, {})
+        return sum(1 for key in keys if hash_.pop(key, None) is not None)
+
+    def _hkeys(self, name):
+        return list(self.data.get(name, {}))
+
+    def _hlen(self, name):
+        return len(self.data.get(name, {}))
+
+    def _hincrby(self, name, key, amount=1):
+        hash_ = self.data.setdefault(name, {})
+        value = int(hash_.get(key, 0)) + amount
+        hash_[key] = str(value)
+        return value
+
+    def _hincrbyfloat(self, name, key, amount=1.0):
+        hash_ = self.data.setdefault(name, {})
+        value = float(hash_.get(key, 0)) + amount
+        hash_[key] = repr(value)
+        return value
+
+    def _llen(self, name):
+        return len(self.data.get(name, []))
+
+    def _rpush(self, name, *values):
+        list_ = self.data.setdefault(name, [])
+        list_.extend(str(value) for value in values)
+        return len(list_)
+
+    def _lpush(self, name, *values):
+        list_ = self.data.setdefault(name, [])
+        list_[:0] = [str(value) for value in reversed(values)]
+        return len(list_)
+
+    def _lpop(self, name):
+        list_ = self.data.get(name)
+        if not list_:
+            return None
+        return list_.pop(0)
+
+    def _ltrim(self, name, start, end):
+        self.data[name] = self._lrange(name, start, end)
+        return True
+
+    def _lrange(self, name, start, end):
+        list_ = self.data.get(name, [])
+        if end < 0:
+            end = len(list_) + end
+        return list_[start:end + 1]
+
+    def _zadd(self, name, **pairs):
+        zset = self.data.setdefault(name, {})
+        added = sum(1 for member in pairs if member not in zset)
+        zset.update(pairs)
+        return added
+
+    def _zcard(self, name):
+        return len(self.data.get(name, {}))
+
+    def _zrange(self, name, start, end):
+        members = sorted(self.data.get(name, {}).items(), key=lambda item: (item[1], item[0]))
+        if end < 0:
+            end = len(members) + end
+        return [member for member, _ in members[start:end + 1]]
+
+    def _zremrangebyscore(self, name, min, max):
+        zset = self.data.get(name, {})
+        stale = [member for member, score in zset.items() if float(min) <= score <= float(max)]
+        for member in stale:
+            del zset[member]
+        return len(stale)
+
+    def _zrem(self, name, *members):
+        zset = self.data.get(name, {})
+        return sum(1 for member in members if zset.pop(member, None) is not None)
+
+
+class FakePipeline(object):
+    """Queues FakeRedis commands and runs them all on execute()."""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.commands = []
+
+    def __getattr__(self, name):
+        if not hasattr(FakeRedis, '_' + name):
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        # One round trip for the lot.
+        self.redis_client._wait()
+        results = [
+            getattr(self.redis_client, '_' + name)(*args, **kwargs)
+            for name, args, kwargs in self.commands
+        ]
+        self.commands = []
+        return results
+
+
+class FakeScript(object):
+    """A Lua script, run by its Python version from _script_emulations()."""
+
+    def __init__(self, redis_client, source):
+        self.registered_client = redis_client
+        self.source = source
+        self.emulate = _script_emulations().get(source)
+        if self.emulate is None:
+            raise NotImplementedError("no emulation of script:\n" + source)
+
+    def __call__(self, keys=[], args=[], client=None):
+        # One round trip, like EVALSHA.
+        self.registered_client._wait()
+        return self.emulate(self.registered_client, list(keys), list(args))
+
+
+def _claim_page(r, keys, args):
+    steps_key, cursor_key = keys
+    page_size, ttl, recipient, now, lease_ms = args
+    state = [int(part) for part in (r._hget(cursor_key, recipient) or '0').split('|')]
+    cursor = state[0]
+    if len(state) == 3 and state[2] > now:
+        return [-1, state[2] - now]
+    blob = r._get(steps_key) or ''
+    count = routeblob.count(blob)
+    last = min(cursor + int(page_size), count)
+    if last <= cursor:
+        return [cursor, 0, '', '', '']
+    index = blob[routeblob.HEADER.size + cursor * routeblob.OFFSET.size:
+                 routeblob.HEADER.size + (last + 1) * routeblob.OFFSET.size]
+    first, = routeblob.OFFSET.unpack_from(index)
+    stop, = routeblob.OFFSET.unpack_from(index, len(index) - routeblob.OFFSET.size)
+    base = routeblob.HEADER.size + (count + 1) * routeblob.OFFSET.size
+    lease = '{}|{}'.format(last, now + lease_ms)
+    r._hset(cursor_key, recipient, '{}|{}'.format(cursor, lease))
+    r._expire(cursor_key, ttl)
+    r._expire(steps_key, ttl)
+    return [cursor, count - last, index, blob[base + first:base + stop], lease]
+
+
+def _commit_cursor(r, keys, args):
+    cursor_key, = keys
+    position, ttl, recipient, lease, release = args
+    cursor, _, current = (r._hget(cursor_key, recipient) or '').partition('|')
+    if not current or current != lease:
+        return 0
+    position = max(int(cursor), int(position))
+    r._hset(cursor_key, recipient, position if release else '{}|{}'.format(position, lease))
+    r._expire(cursor_key, ttl)
+    return 1
+
+
+def _token_bucket(r, key, rate, burst, now):
+    tokens, ts = r._hmget(key, ['tokens', 'ts'])
+    tokens = float(burst if tokens is None else tokens)
+    ts = float(now if ts is None else ts)
+    return min(burst, tokens + max(0, now - ts) * rate / 1000.0), max(now, ts)
+
+
+def _take_token(r, keys, args):
+    key, = keys
+    rate, burst, now, max_wait = float(args[0]), int(args[1]), int(args[2]), int(args[3])
+    tokens, ts = _token_bucket(r, key, rate, burst, now)
+    tokens -= 1
+    wait = int(math.ceil(-tokens * 1000 / rate)) if tokens < 0 else 0
+    if wait > max_wait:
+        return [0, wait]
+    r._hmset(key, {'tokens': tokens, 'ts': ts})
+    return [1, wait]
+
+
+def _choose_sender(r, keys, args):
+    ttl, now, rate, burst, max_wait, start = args[:6]
+    rate, burst = float(rate), int(burst)
+    senders = args[6:]
+    n = len(senders)
+
+    def tokens(i):
+        if rate <= 0:
+            return burst
+        return _token_bucket(r, keys[1 + n + i], rate, burst, now)[0]
+
+    def cooling(i):
+        return r._exists(keys[1 + i])
+
+    current = r._get(keys[0])
+    if current in senders:
+        i = senders.index(current)
+        if not cooling(i) and (rate <= 0 or -tokens(i) * 1000 / rate <= max_wait):
+            r._expire(keys[0], ttl)
+            return current
+
+    best = None
+    for k in xrange(n):
+        i = (start + k) % n
+        if not cooling(i) and (best is None or tokens(i) > tokens(best)):
+            best = i
+    if best is None:
+        best = senders.index(current) if current in senders else start % n
+    r._setex(keys[0], senders[best], ttl)
+    return senders[best]
+
+
+def _pop(r, keys, args):
+    pending_key, depth_key, active_key = keys
+    item = r._lpop(pending_key)
+    if item is not None:
+        r._incr(depth_key, -1)
+    r._expire(active_key, args[0])
+    return item
+
+
+def _release(r, keys, args):
+    pending_key, active_key = keys
+    if r._llen(pending_key):
+        r._expire(active_key, args[0])
+        return 1
+    r._delete(active_key)
+    return 0
+
+
+def _claim_prefetch(r, keys, args):
+    wanted, user_budget, global_budget, window = [int(arg) for arg in args]
+    user_used, global_used = [int(r._get(key) or 0) for key in keys]
+    granted = max(0, min(wanted, user_budget - user_used, global_budget - global_used))
+    if granted:
+        for key in keys:
+            r._incr(key, granted)
+            if r._ttl(key) is None:
+                r._expire(key, window)
+    return granted
+
+
+def _get_route(r, keys, args):
+    encoded = r._get(keys[0])
+    if encoded is not None:
+        r._zadd(keys[1], **{keys[0]: float(args[0])})
+    return encoded
+
+
+def _app_scripts():
+    for module in (cache, client, fairqueue, maps):
+        for name, value in sorted(vars(module).items()):
+            if isinstance(value, LazyScript):
+                yield '{}.{}'.format(module.__name__, name), value
+
+
+def check_emulations():
+    """Raise if any of the app's Lua scripts has no Python version here.
+
+    Each emulation records the SHA-1 of the source it was written
+    against, so this also catches a script that's been edited since.
+    """
+    emulations = _script_emulations()
+    missing = [name for name, script in _app_scripts() if script.source not in emulations]
+    if missing:
+        raise NotImplementedError(
+            "no emulation of {}; update bench/stubs.py or run against a real "
+            "redis-server".format(', '.join(missing)))
+
+
+# Script name: (SHA-1 of the source emulated, emulation).
+EMULATIONS = {
+    'cache.get_route_script': ('1835468e4df5', _get_route),
+    'client.choose_sender_script': ('30e4a5ba7c63', _choose_sender),
+    'client.claim_page_script': ('bb361f13ff63', _claim_page),
+    'client.commit_cursor_script': ('27c8664a3cb1', _commit_cursor),
+    'client.take_token_script': ('02dc1b571e6d', _take_token),
+    'fairqueue.pop_script': ('b06d4dd540c9', _pop),
+    'fairqueue.release_script': ('019be91a88b6', _release),
+    'maps.claim_prefetch_script': ('1b2aa29d7940', _claim_prefetch),
+}
+
+
+def _script_emulations():
+    """Python versions of the app's Lua scripts, by source, if up to date."""
+    emulations = {}
+    for name, script in _app_scripts():
+        digest, emulate = EMULATIONS.get(name, (None, None))
+        if digest == hashlib.sha1(script.source).hexdigest()[:12]:
+            emulations[script.source] = emulate
+    return emulations
+
+
+class FakeQueue(object):
+    """Records rq enqueues instead of running them.
+
+    Jobs are kept as (func, args, kwargs, enqueued at); take() hands out
+    the oldest, for anything standing in for a worker.
+    """
+
+    def __init__(self, name='default', latency=no_latency):
+        self.name = name
+        self.latency = latency
+        self.jobs = []
+
+    def enqueue(self, func, *args, **kwargs):
+        delay = self.latency()
+        if delay:
+            time.sleep(delay)
+        self.jobs.append((func, args, kwargs, time.time()))
+
+    def take(self):
+        try:
+            return self.jobs.pop(0)
+        except IndexError:
+            return None
+
+    def enqueue_call(self, func, args=None, kwargs=None, **options):
+        self.enqueue(func, *(args or ()), **(kwargs or {}))
+
+    @property
+    def count(self):
+        return len(self.jobs)
+
+
+class RedisQueue(object):
+    """A FakeQueue kept in a Redis list, so forked workers can share it."""
+
+    def __init__(self, name, redis_client, latency=no_latency):
+        self.name = name
+        self.redis_client = redis_client
+        self.latency = latency
+        self.key = 'bench:queue:{}'.format(name)
+
+    def enqueue(self, func, *args, **kwargs):
+        delay = self.latency()
+        if delay:
+            time.sleep(delay)
+        job = (func, args, kwargs, time.time())
+        self.redis_client.rpush(self.key, pickle.dumps(job, pickle.HIGHEST_PROTOCOL))
+
+    def take(self):
+        job = self.redis_client.lpop(self.key)
+        return pickle.loads(job) if job is not None else None
+
+    def enqueue_call(self, func, args=None, kwargs=None, **options):
+        self.enqueue(func, *(args or ()), **(kwargs or {}))
+
+    @property
+    def count(self):
+        return self.redis_client.llen(self.key)
+
+
+class StubGeocoder(object):
+    """Answers every query with a point near 645 Harrison St, SF."""
+
+    def __init__(self, latency=no_latency):
+        self.latency = latency
+        self.calls = 0
+
+    def geocode(self, query):
+        self.calls += 1
+        delay = self.latency()
+        if delay:
+            time.sleep(delay)
+        if 'nowhere' in query.lower():
+            raise ValueError("Didn't find exactly one placemark! (Found 0.)")
+        offset = (hash(query) % 1000) / 100000.0
+        return u'{}, San Francisco, CA, USA'.format(query), (37.7819 + offset, -122.3973 - offset)
+
+
+class StubURLOpener(object):
+    """Replacement for urllib.urlopen that answers with a Directions fixture."""
+
+    def __init__(self, fixture='directions_short.json', latency=no_latency):
+        self.body = load_fixture(fixture)
+        self.latency = latency
+
+    def __call__(self, url):
+        delay = self.latency()
+        if delay:
+            time.sleep(delay)
+        return StringIO(self.body)
+
+
+class StubResponse(object):
+    status_code = 201
+    content = json.dumps({'status': 'queued'})
+    url = 'https://api.twilio.com/'
+
+
+class StubHTTPSession(object):
+    """Replacement for client.http_session that accepts every message."""
+
+    def __init__(self, latency=no_latency):
+        self.latency = latency
+        self.sent = []
+
+    def post(self, url, data=None, **kwargs):
+        delay = self.latency()
+        if delay:
+            time.sleep(delay)
+        self.sent.append(data)
+        return StubResponse()
+
+
+class Stubs(object):
+    """The stand-ins install() wired up, for inspection."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+@contextmanager
+def scratch_redis(url=None, executable=None):
+    """Yield a client for a Redis the benchmarks may flush, or None for FakeRedis.
+
+    That's `url` if given, else a redis-server (`executable`, or the one
+    on PATH) started on a unix socket for the duration.
+    """
+    if url:
+        yield redis.from_url(url)
+        return
+
+    executable = executable or find_executable('redis-server')
+    if executable is None:
+        sys.stderr.write("no redis-server found; using FakeRedis, which only "
+                         "emulates the Lua scripts\n")
+        check_emulations()
+        yield None
+        return
+
+    tmp = tempfile.mkdtemp()
+    socket = os.path.join(tmp, 'redis.sock')
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen(
+            [executable, '--port', '0', '--unixsocket', socket,
+             '--save', '', '--appendonly', 'no'],
+            stdout=devnull,
+        )
+    try:
+        redis_client = redis.Redis(unix_socket_path=socket)
+        deadline = time.time() + 10
+        while True:
+            try:
+                redis_client.ping()
+                break
+            except redis.ConnectionError:
+                if server.poll() is not None or time.time() > deadline:
+                    raise
+                time.sleep(0.01)
+        yield redis_client
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+# (object, attribute) -> what install() replaced, for uninstall().
+_originals = {}
+
+
+def _patch(obj, name, value):
+    _originals.setdefault((obj, name), getattr(obj, name))
+    setattr(obj, name, value)
+
+
+def install(redis_client=None,
+            redis_latency=no_latency,
+            geocode_latency=no_latency,
+            directions_latency=no_latency,
+            twilio_latency=no_latency,
+            queue_latency=no_latency,
+            directions_fixture='directions_short.json',
+            shared_queues=False):
+    """Point maps and client at stand-ins for all their services, until uninstall().
+
+    `redis_client` is a scratch Redis, which is flushed; by default, a
+    fresh FakeRedis. Each *_latency is a function returning how long (in
+    seconds) one call to that service should take; redis_latency only
+    applies to FakeRedis. With `shared_queues`, rq queues are RedisQueues
+    rather than FakeQueues, for running jobs in other processes.
+    """
+    if redis_client is None:
+        if shared_queues:
+            raise ValueError("shared_queues needs a real Redis")
+        check_emulations()
+        redis_client = FakeRedis(redis_latency)
+    else:
+        redis_client.flushdb()
+
+    stubs = Stubs(
+        redis=redis_client,
+        geocoder=StubGeocoder(geocode_latency),
+        urlopen=StubURLOpener(directions_fixture, directions_latency),
+        http_session=StubHTTPSession(twilio_latency),
+        queues=dict(
+            (name, RedisQueue(name, redis_client, queue_latency) if shared_queues
+             else FakeQueue(name, queue_latency))
+            for name in fairqueue.queues),
+    )
+
+    _patch(maps, 'redis_client', stubs.redis)
+    _patch(maps, 'geocoder', stubs.geocoder)
+    _patch(maps, 'geocode_cache', GeocodeCache(stubs.geocoder, stubs.redis))
+    _patch(maps, 'route_cache', RouteCache(stubs.redis))
+    _patch(urllib, 'urlopen', stubs.urlopen)
+
+    _patch(client, 'redis_client', stubs.redis)
+    _patch(client, 'http_session', stubs.http_session)
+    _patch(metrics.registry, 'redis_client', stubs.redis)
+    _patch(fairqueue, 'redis_client', stubs.redis)
+    _patch(fairqueue, 'queues', stubs.queues)
+    return stubs
+
+
+def uninstall():
+    """Put back everything install() replaced."""
+    for (obj, name), value in _originals.items():
+        setattr(obj, name, value)
+    _originals.clear()
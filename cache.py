@@ -0,0 +1,247 @@
+"""Caches in front of the Google APIs we call from the webhook."""
+import collections
+import hashlib
+import json
+import os
+import re
+import time
+
+import metrics
+from client import LazyScript
+
+
+GEOCODE_CACHE_SIZE = int(os.getenv('GEOCODE_CACHE_SIZE', '2048'))
+GEOCODE_CACHE_TTL = int(os.getenv('GEOCODE_CACHE_TTL', str(7 * 24 * 60 * 60)))
+GEOCODE_NEGATIVE_TTL = int(os.getenv('GEOCODE_NEGATIVE_TTL', str(60 * 60)))
+GEOCODE_KEY_TMPL = "geocode:{query}"
+
+ROUTE_CACHE_SIZE = int(os.getenv('ROUTE_CACHE_SIZE', '5000'))
+ROUTE_CACHE_TTL = int(os.getenv('ROUTE_CACHE_TTL', str(24 * 60 * 60)))
+# Bump the version whenever the shape of the cached steps changes.
+ROUTE_KEY_TMPL = "route:v3:{digest}"
+ROUTE_INDEX_KEY = "route:index"
+
+# GET a cached route, marking it used (ARGV[1] is the time) only if it's
+# there, so misses don't take up room in the index. One round trip.
+get_route_script = LazyScript("""
+local encoded = redis.call('GET', KEYS[1])
+if encoded then
+    redis.call('ZADD', KEYS[2], ARGV[1], KEYS[1])
+end
+return encoded
+""")
+
+ABBREVIATIONS = {
+    'street': 'st',
+    'avenue': 'ave',
+    'av': 'ave',
+    'boulevard': 'blvd',
+    'road': 'rd',
+    'drive': 'dr',
+    'lane': 'ln',
+    'place': 'pl',
+    'court': 'ct',
+    'terrace': 'ter',
+    'highway': 'hwy',
+    'parkway': 'pkwy',
+    'square': 'sq',
+    'suite': 'ste',
+    'north': 'n',
+    'south': 's',
+    'east': 'e',
+    'west': 'w',
+    'california': 'ca',
+    'san francisco': 'sf',
+}
+
+_PUNCTUATION_RE = re.compile(r'[^\w\s#]', re.UNICODE)
+_WHITESPACE_RE = re.compile(r'\s+', re.UNICODE)
+_ABBREVIATIONS_RE = re.compile(
+    r'\b({})\b'.format('|'.join(
+        sorted(ABBREVIATIONS, key=len, reverse=True))),
+)
+
+
+def normalize_query(query):
+    """Fold a free-text location so trivially different spellings share a key.
+
+    "645 Harrison Street, San Francisco" and "645 harrison st  sf" both
+    become "645 harrison st sf".
+    """
+    if isinstance(query, str):
+        query = query.decode('utf-8', 'replace')
+    query = _PUNCTUATION_RE.sub(' ', query.lower())
+    query = _WHITESPACE_RE.sub(' ', query).strip()
+    return _ABBREVIATIONS_RE.sub(lambda m: ABBREVIATIONS[m.group(1)], query)
+
+
+class LRUCache(object):
+    """A bounded in-process mapping with per-entry expiry."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        try:
+            expires, value = self._entries.pop(key)
+        except KeyError:
+            return default
+
+        if expires < time.time():
+            return default
+
+        # Re-insert to mark as most recently used.
+        self._entries[key] = (expires, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._entries.pop(key, None)
+        if ttl is None:
+            ttl = self.ttl
+        self._entries[key] = (time.time() + ttl, value)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class GeocodeCache(object):
+    """Two-tier (process LRU, then Redis) cache around a geopy geocoder.
+
+    Lookups that fail with ValueError ("no unique match") are cached too,
+    for a shorter time, so repeated bad queries don't reach Google either.
+    """
+
+    def __init__(self, geocoder, redis_client,
+                 maxsize=GEOCODE_CACHE_SIZE,
+                 ttl=GEOCODE_CACHE_TTL,
+                 negative_ttl=GEOCODE_NEGATIVE_TTL):
+        self.geocoder = geocoder
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.local = LRUCache(maxsize, ttl)
+        self.stats = collections.Counter()
+
+    def geocode(self, query):
+        """Return (place, (lat, lon)) like geocoder.geocode, or raise ValueError."""
+        key = normalize_query(query)
+
+        entry = self.local.get(key)
+        if entry is not None:
+            self.stats['local_hits'] += 1
+        else:
+            entry = self._get_shared(key)
+            if entry is not None:
+                self.stats['redis_hits'] += 1
+                self.local.set(key, entry, self._ttl_for(entry))
+            else:
+                self.stats['misses'] += 1
+                entry = self._lookup(query)
+                self._set(key, entry)
+
+        if 'error' in entry:
+            self.stats['negative_hits'] += 1
+            raise ValueError(entry['error'])
+        return entry['place'], (entry['lat'], entry['lon'])
+
+    def hit_rate(self):
+        hits = self.stats['local_hits'] + self.stats['redis_hits']
+        total = hits + self.stats['misses']
+        if not total:
+            return 0.0
+        return float(hits) / total
+
+    def _lookup(self, query):
+        try:
+            place, (lat, lon) = self.geocoder.geocode(query)
+        except ValueError as e:
+            return {'error': unicode(e)}
+        except Exception:
+            metrics.incr('upstream_errors_total', service='geocode')
+            raise
+        return {'place': place, 'lat': lat, 'lon': lon}
+
+    def _ttl_for(self, entry):
+        if 'error' in entry:
+            return self.negative_ttl
+        return self.ttl
+
+    def _get_shared(self, key):
+        encoded = self.redis_client.get(GEOCODE_KEY_TMPL.format(query=key.encode('utf-8')))
+        if encoded is None:
+            return None
+        return json.loads(encoded)
+
+    def _set(self, key, entry):
+        ttl = self._ttl_for(entry)
+        self.local.set(key, entry, ttl)
+        self.redis_client.setex(
+            name=GEOCODE_KEY_TMPL.format(query=key.encode('utf-8')),
+            value=json.dumps(entry),
+            time=ttl,
+        )
+
+
+class RouteCache(object):
+    """Redis cache of fully built direction steps, keyed by (origin, destination).
+
+    Every entry has a TTL, and a sorted set of last-use times bounds the
+    number of cached routes: the least recently used ones are evicted once
+    there are more than `maxsize`. Index entries unused for longer than the
+    TTL belong to routes that have expired, and are dropped on each set().
+    """
+
+    def __init__(self, redis_client, maxsize=ROUTE_CACHE_SIZE, ttl=ROUTE_CACHE_TTL):
+        self.redis_client = redis_client
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stats = collections.Counter()
+
+    def get(self, origin, destination):
+        key = self._key(origin, destination)
+        encoded = get_route_script(
+            keys=[key, ROUTE_INDEX_KEY],
+            args=[time.time()],
+            client=self.redis_client,
+        )
+        if encoded is None:
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        return json.loads(encoded)
+
+    def set(self, origin, destination, steps):
+        key = self._key(origin, destination)
+        now = time.time()
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.setex(name=key, value=json.dumps(steps), time=self.ttl)
+        pipe.zadd(ROUTE_INDEX_KEY, **{key: now})
+        pipe.zremrangebyscore(ROUTE_INDEX_KEY, '-inf', now - self.ttl)
+        pipe.zcard(ROUTE_INDEX_KEY)
+        _, _, _, size = pipe.execute()
+
+        if size > self.maxsize:
+            self._evict(size - self.maxsize)
+
+    def _evict(self, count):
+        stale = self.redis_client.zrange(ROUTE_INDEX_KEY, 0, count - 1)
+        if not stale:
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.delete(*stale)
+        pipe.zrem(ROUTE_INDEX_KEY, *stale)
+        pipe.execute()
+        self.stats['evictions'] += len(stale)
+
+    def _key(self, origin, destination):
+        normalized = u'{}\n{}'.format(
+            normalize_query(origin),
+            normalize_query(destination),
+        )
+        digest = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+        return ROUTE_KEY_TMPL.format(digest=digest)
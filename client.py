@@ -1,13 +1,341 @@
-import json
 import os
+import time
+import zlib
 
 import redis
 import requests
+from requests.adapters import HTTPAdapter
+
+import media
+import metrics
+import routeblob
+from directions import streetview_url
 
 MESSAGES_URL = 'https://api.twilio.com/2010-04-01/Accounts/{acct_sid}/Messages'
 TWILIO_SHORTCODE = '894546'
-STEPS_KEY_TMPL = "steps:{phone_number}"
+# Session keys live under s:<schema version>:. Locations, places and
+# paging cursors are fields in one of SESSION_BUCKETS hashes rather than
+# keys of their own, which keeps the hashes small enough for Redis's
+# compact encoding; see session.py.
+SESSION_PREFIX = "s:v1:"
+SESSION_BUCKETS = int(os.getenv('SESSION_BUCKETS', '1024'))
+STEPS_KEY_TMPL = SESSION_PREFIX + "steps:{phone_number}"
+CURSOR_KEY_TMPL = SESSION_PREFIX + "cur:{bucket}"
+LOCATION_KEY_TMPL = SESSION_PREFIX + "loc:{bucket}"
+PLACE_KEY_TMPL = SESSION_PREFIX + "place:{bucket}"
+RATELIMIT_KEY_TMPL = "ratelimit:{sender}"
+SENDER_KEY_TMPL = "sender:{recipient}"
+COOLDOWN_KEY_TMPL = "cooldown:{sender}"
 REDIS_EXPIRATION = 6 * 60 * 60
+NEXT_PAGE_TMPL = u'{} (Reply "next" for next page)'
+
+ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
+AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
+SENDER_ACCOUNT = os.getenv('SENDER_ACCOUNT', ACCOUNT_SID)
+
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3.05'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '15'))
+
+# Messages per second allowed from each sender number, shared by every
+# process sending from it. Unset (or 0) to send as fast as we can.
+SEND_RATE = float(os.getenv('SEND_RATE', '0'))
+# How many messages may go out back to back after a quiet spell.
+SEND_BURST = int(os.getenv('SEND_BURST', '1'))
+# The longest, in seconds, a send will wait for its slot. A page of
+# PAGE_SIZE sends has to fit in rq's 180 second job timeout; past this,
+# SendThrottled is raised and no slot is taken.
+SEND_MAX_WAIT = float(os.getenv('SEND_MAX_WAIT', '30'))
+# How long a claimed page is reserved for the job sending it, in ms: rq's
+# job timeout, after which that job is dead anyway.
+PAGE_LEASE_MS = 180 * 1000
+# Most a job waits, in seconds, to look again at a page another job has
+# leased. The lease is usually given up long before it runs out.
+PAGE_BUSY_RETRY = 1.0
+
+# Comma-separated short codes and/or long codes to send from, written as
+# Twilio writes them (e.g. +14155550100). Each recipient sticks to the one
+# they last wrote to, unless it's cooling down or too far behind.
+TWILIO_SENDERS = [
+    sender.strip()
+    for sender in os.getenv('TWILIO_SENDERS', TWILIO_SHORTCODE).split(',')
+    if sender.strip()
+]
+# How long a sender is passed over after Twilio refuses a send from it.
+SENDER_COOLDOWN = int(os.getenv('SENDER_COOLDOWN', '60'))
+# A recipient moves to another sender if theirs is this far (in seconds)
+# behind on its SEND_RATE.
+SENDER_MAX_WAIT = float(os.getenv('SENDER_MAX_WAIT', '5'))
+
+
+def _build_session():
+    """A keep-alive session shared by every send in this process."""
+    session = requests.Session()
+    session.auth = (ACCOUNT_SID, AUTH_TOKEN)
+    session.headers['Connection'] = 'keep-alive'
+    session.mount('https://', HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=HTTP_POOL_SIZE,
+    ))
+    return session
+
+
+def session_bucket(phone_number):
+    """Which of the SESSION_BUCKETS hashes holds `phone_number`'s fields."""
+    return (zlib.crc32(phone_number.encode('utf-8')) & 0xffffffff) % SESSION_BUCKETS
+
+
+class RetryLater(Exception):
+    """Nothing went wrong, but the work can't go ahead for `retry_after` seconds."""
+
+    def __init__(self, message, retry_after):
+        super(RetryLater, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class SendThrottled(RetryLater):
+    """A sender is booked up more than SEND_MAX_WAIT ahead.
+
+    `retry_after` is how many seconds until it has a slot within that.
+    """
+
+    def __init__(self, sender, retry_after):
+        super(SendThrottled, self).__init__(
+            "{} is throttled for another {:.1f}s".format(sender, retry_after), retry_after)
+        self.sender = sender
+
+
+class PageBusy(RetryLater):
+    """Another job is still sending a recipient their last page.
+
+    Whichever class queued it: the lease on the page is per recipient.
+    """
+
+    def __init__(self, recipient, lease_left):
+        super(PageBusy, self).__init__(
+            "{} has a page in flight, leased for another {:.1f}s".format(recipient, lease_left),
+            min(lease_left, PAGE_BUSY_RETRY))
+        self.recipient = recipient
+
+
+class LazyScript(object):
+    """A Lua script that's only loaded into Redis the first time it runs.
+
+    redis_client.register_script() loads it straight away, which would make
+    importing the module need a live Redis. `get_client` returns the client
+    to run it with, unless one is passed in; by default, this module's
+    redis_client.
+    """
+
+    def __init__(self, source, get_client=None):
+        self.source = source
+        self.get_client = get_client or (lambda: redis_client)
+        self._script = None
+
+    def __call__(self, keys=[], args=[], client=None):
+        client = client or self.get_client()
+        if self._script is None or self._script.registered_client is not client:
+            self._script = client.register_script(self.source)
+        return self._script(keys=keys, args=args)
+
+
+http_session = _build_session()
+redis_client = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
+
+# A recipient's cursor is field ARGV[3] of a bucket hash: "<cursor>" or,
+# while a page is being sent, "<cursor>|<page end>|<lease expiry, ms>".
+
+# Reserve the page of steps starting at the cursor and return it, plus how
+# many steps are left after it and the lease to commit with, in one round
+# trip. While another job's lease on the recipient is live (ARGV[4] is
+# the caller's clock in ms), returns {-1, ms until it runs out} instead.
+# Steps are stored packed by routeblob (a 3 byte header, then 4 byte
+# offsets); this returns the page's slices of the index and records.
+claim_page_script = LazyScript("""
+local state = {}
+for part in string.gmatch(redis.call('HGET', KEYS[2], ARGV[3]) or '0', '[^|]+') do
+    state[#state + 1] = tonumber(part)
+end
+local cursor = state[1]
+local now = tonumber(ARGV[4])
+if state[3] and state[3] > now then
+    return {-1, state[3] - now}
+end
+local header = redis.call('GETRANGE', KEYS[1], 0, 2)
+if #header < 3 then
+    return {cursor, 0, '', '', ''}
+end
+local _, count = struct.unpack('<BH', header)
+local last = math.min(cursor + tonumber(ARGV[1]), count)
+if last <= cursor then
+    return {cursor, 0, '', '', ''}
+end
+local index = redis.call('GETRANGE', KEYS[1], 3 + cursor * 4, 3 + last * 4 + 3)
+local first = struct.unpack('<I', index)
+local stop = struct.unpack('<I', index, #index - 3)
+local base = 3 + (count + 1) * 4
+local records = redis.call('GETRANGE', KEYS[1], base + first, base + stop - 1)
+local lease = string.format('%d|%d', last, now + tonumber(ARGV[5]))
+redis.call('HSET', KEYS[2], ARGV[3], cursor .. '|' .. lease)
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return {cursor, count - last, index, records, lease}
+""")
+
+# Move the cursor forward to ARGV[1] (it never moves backwards) under the
+# lease in ARGV[4], giving the lease up if ARGV[5] is 1. Returns 0, moving
+# nothing, if the lease is gone: the route was replaced, or the lease ran
+# out and the page was claimed again.
+commit_cursor_script = LazyScript("""
+local cursor, lease = string.match(redis.call('HGET', KEYS[1], ARGV[3]) or '', '^(%d+)|(.*)$')
+if lease ~= ARGV[4] then
+    return 0
+end
+local position = math.max(tonumber(cursor), tonumber(ARGV[1]))
+if ARGV[5] == '1' then
+    redis.call('HSET', KEYS[1], ARGV[3], position)
+else
+    redis.call('HSET', KEYS[1], ARGV[3], position .. '|' .. lease)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+# Token bucket per sender, refilled at ARGV[1] tokens/sec up to ARGV[2].
+# Takes a token even when that lets the bucket go negative, and returns
+# {1, ms the caller must wait before sending}: each caller is given the
+# next free slot instead of everyone retrying at once. A slot more than
+# ARGV[4] ms away isn't taken, and {0, ms} is returned instead. ARGV[3]
+# is the caller's clock in ms, since scripts can't write after reading
+# TIME.
+take_token_script = LazyScript("""
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000) - 1
+local wait = 0
+if tokens < 0 then
+    wait = math.ceil(-tokens * 1000 / rate)
+end
+if wait > tonumber(ARGV[4]) then
+    return {0, wait}
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', math.max(now, ts))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) * 1000 / rate) + 1000)
+return {1, wait}
+""")
+
+# Pick the sender for a recipient. KEYS are the recipient's sticky sender,
+# then each sender's cooldown key, then each sender's token bucket; ARGV
+# is ttl, now (ms), rate, burst, max wait (ms), a start offset and the
+# senders. The sticky sender is kept unless it's cooling down or too far
+# behind; otherwise the healthy sender with the most tokens left wins,
+# ties going to the first from the offset so recipients spread out.
+choose_sender_script = LazyScript("""
+local ttl = tonumber(ARGV[1])
+local now = tonumber(ARGV[2])
+local rate = tonumber(ARGV[3])
+local burst = tonumber(ARGV[4])
+local max_wait = tonumber(ARGV[5])
+local start = tonumber(ARGV[6])
+local senders = {unpack(ARGV, 7)}
+local n = #senders
+
+local function tokens(i)
+    if rate <= 0 then
+        return burst
+    end
+    local state = redis.call('HMGET', KEYS[1 + n + i], 'tokens', 'ts')
+    local t = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    return math.min(burst, t + math.max(0, now - ts) * rate / 1000)
+end
+
+local function cooling(i)
+    return redis.call('EXISTS', KEYS[1 + i]) == 1
+end
+
+local current = redis.call('GET', KEYS[1])
+local current_index = nil
+for i = 1, n do
+    if senders[i] == current then
+        current_index = i
+    end
+end
+if current_index and not cooling(current_index) and
+        (rate <= 0 or -tokens(current_index) * 1000 / rate <= max_wait) then
+    redis.call('EXPIRE', KEYS[1], ttl)
+    return current
+end
+
+local best, best_tokens = nil, nil
+for k = 0, n - 1 do
+    local i = (start + k) % n + 1
+    if not cooling(i) then
+        local t = tokens(i)
+        if best == nil or t > best_tokens then
+            best, best_tokens = i, t
+        end
+    end
+end
+if best == nil then
+    -- Everyone is cooling down; don't make things worse by moving.
+    best = current_index or (start % n + 1)
+end
+redis.call('SETEX', KEYS[1], ttl, senders[best])
+return senders[best]
+""")
+
+
+def sender_for(recipient):
+    """The number to send to `recipient` from, out of TWILIO_SENDERS."""
+    if len(TWILIO_SENDERS) == 1:
+        return TWILIO_SENDERS[0]
+    keys = [SENDER_KEY_TMPL.format(recipient=recipient)]
+    keys.extend(COOLDOWN_KEY_TMPL.format(sender=sender) for sender in TWILIO_SENDERS)
+    keys.extend(RATELIMIT_KEY_TMPL.format(sender=sender) for sender in TWILIO_SENDERS)
+    return choose_sender_script(
+        keys=keys,
+        args=[
+            REDIS_EXPIRATION,
+            int(time.time() * 1000),
+            SEND_RATE,
+            SEND_BURST,
+            int(SENDER_MAX_WAIT * 1000),
+            zlib.crc32(recipient.encode('utf-8')) & 0xffffffff,
+        ] + TWILIO_SENDERS,
+    )
+
+
+def _cool_down(sender):
+    if len(TWILIO_SENDERS) > 1:
+        redis_client.setex(
+            name=COOLDOWN_KEY_TMPL.format(sender=sender),
+            value=1,
+            time=SENDER_COOLDOWN,
+        )
+
+
+def _wait_for_send_slot(sender):
+    """Block until `sender` may send another message under SEND_RATE.
+
+    Raises SendThrottled, rather than block for longer than SEND_MAX_WAIT.
+    """
+    if not SEND_RATE:
+        return
+    taken, wait_ms = take_token_script(
+        keys=[RATELIMIT_KEY_TMPL.format(sender=sender)],
+        args=[SEND_RATE, SEND_BURST, int(time.time() * 1000), int(SEND_MAX_WAIT * 1000)],
+    )
+    if not taken:
+        metrics.incr('send_throttled_total')
+        raise SendThrottled(sender, wait_ms / 1000.0 - SEND_MAX_WAIT)
+    metrics.observe('send_wait_seconds', wait_ms / 1000.0)
+    if wait_ms:
+        time.sleep(wait_ms / 1000.0)
 
 
 def send_message(to, from_, body=None, media_urls=None):
@@ -16,10 +344,6 @@ def send_message(to, from_, body=None, media_urls=None):
     Because we can't publish the real deal yet so we can't run it in Heroku,
     that's why.
     """
-    account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-    auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-    sender_account = os.getenv('SENDER_ACCOUNT', account_sid)
-
     if body is None and media_urls is None:
         raise ValueError("Need to specify at least one of body, media_urls")
 
@@ -30,47 +354,97 @@ def send_message(to, from_, body=None, media_urls=None):
         'MediaUrl': media_urls,
     }
 
-    res = requests.post(
-        MESSAGES_URL.format(acct_sid=sender_account),
-        auth=(account_sid, auth_token),
-        data=params,
-    )
+    _wait_for_send_slot(from_)
+
+    try:
+        with metrics.timer('stage_seconds', stage='twilio_send'):
+            res = http_session.post(
+                MESSAGES_URL.format(acct_sid=SENDER_ACCOUNT),
+                data=params,
+                timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+            )
+    except requests.RequestException:
+        metrics.incr('upstream_errors_total', service='twilio')
+        _cool_down(from_)
+        raise
 
     if res.status_code != 201:
+        metrics.incr('upstream_errors_total', service='twilio')
+        # Throttling and server errors are the sender's trouble; anything
+        # else is most likely a bad recipient.
+        if res.status_code == 429 or res.status_code >= 500:
+            _cool_down(from_)
         raise ValueError("Error sending message: {} (request: {}, {})".format(
             res.content,
             res.url,
             params,
         ))
+    metrics.incr('messages_sent_total')
 
 
 def send_directions_page(recipient, page_size):
-    redis_client = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
-    key = STEPS_KEY_TMPL.format(phone_number=recipient)
-
-    steps = redis_client.lrange(key, 0, page_size - 1)
-    length = redis_client.llen(key)
-    redis_client.ltrim(key, page_size, length - 1)
-    head, tail = steps[:-1], steps[-1]
-    for step in head:
-        decoded = json.loads(step)
-        send_message(
-            recipient,
-            TWILIO_SHORTCODE,
-            body=decoded['text'],
-            media_urls=[decoded['image']],
+    """Send the next page of stored steps, resuming where the last send stopped.
+
+    The page is leased to this job while it's sent, so two jobs can't
+    send the same steps; while another has it, PageBusy is raised. The
+    cursor is committed after every message that goes out, so if this job
+    fails part way through and is retried, only the unsent steps are sent
+    again. If the sender is throttled, the recipient is moved to another
+    one with room; with none, SendThrottled is raised for the rest of the
+    page to be sent later.
+    """
+    steps_key = STEPS_KEY_TMPL.format(phone_number=recipient)
+    cursor_key = CURSOR_KEY_TMPL.format(bucket=session_bucket(recipient))
+
+    with metrics.timer('stage_seconds', stage='claim_page'):
+        claimed = claim_page_script(
+            keys=[steps_key, cursor_key],
+            args=[page_size, REDIS_EXPIRATION, recipient, int(time.time() * 1000), PAGE_LEASE_MS],
         )
+    if claimed[0] < 0:
+        raise PageBusy(recipient, claimed[1] / 1000.0)
+    cursor, remaining, index, records, lease = claimed
+    page = routeblob.decode_page(index, records)
+    if not page:
+        return
+
+    position = cursor
+    try:
+        sender = sender_for(recipient)
+        tried = set([sender])
+        for offset, step in enumerate(page):
+            body = step['text']
+            if offset == len(page) - 1 and remaining > 0:
+                body = NEXT_PAGE_TMPL.format(body)
+
+            while True:
+                try:
+                    send_message(
+                        recipient,
+                        sender,
+                        body=body,
+                        media_urls=[media.proxy_url(
+                            streetview_url(step['lat'], step['lon'], step['heading']))],
+                    )
+                    break
+                except SendThrottled:
+                    sender = sender_for(recipient)
+                    if sender in tried:
+                        raise
+                    tried.add(sender)
+            position += 1
+            last = position == cursor + len(page)
+            if not _commit_cursor(cursor_key, recipient, position, lease, last):
+                # Someone else has the recipient's steps now.
+                return
+    except Exception:
+        # Hand back the rest of the page, so a retry needn't wait out the lease.
+        _commit_cursor(cursor_key, recipient, position, lease, True)
+        raise
+
 
-    decoded = json.loads(tail)
-    if redis_client.llen(key) > 0:
-        body = '{} (Reply "next" for next page)'.format(decoded['text'])
-        redis_client.expire(key, REDIS_EXPIRATION)
-    else:
-        body = decoded['text']
-
-    send_message(
-        recipient,
-        TWILIO_SHORTCODE,
-        body=body,
-        media_urls=[decoded['image']],
+def _commit_cursor(cursor_key, recipient, position, lease, release):
+    return commit_cursor_script(
+        keys=[cursor_key],
+        args=[position, REDIS_EXPIRATION, recipient, lease, int(release)],
     )
@@ -0,0 +1,181 @@
+"""Turning a Directions API route into the steps we text out."""
+import collections
+import htmlentitydefs
+import os
+import re
+from itertools import izip
+from math import atan2
+from math import cos
+from math import degrees
+from math import radians
+from math import sin
+from urllib import urlencode
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+
+STREETVIEW_URI = 'http://maps.googleapis.com/maps/api/streetview'
+DEFAULT_MAPS_PARAMS = {'sensor': 'false', 'size': '640x640'}
+
+# Only the location and heading change from one Street View image to the
+# next, so encode everything else once.
+STREETVIEW_URL_TMPL = '{}?{}&location={{lat}}%2C{{lon}}&heading={{heading}}'.format(
+    STREETVIEW_URI,
+    urlencode(DEFAULT_MAPS_PARAMS),
+)
+
+ARRIVAL_MSG = u"Hopefully you ended up somewhere looking sort of like this."
+
+# Below this many steps numpy's per-call overhead costs more than it saves.
+NUMPY_MIN_STEPS = 16
+
+# Fold runs of short or straight-ahead steps into one message each.
+COMPACT_STEPS = bool(os.getenv('COMPACT_STEPS'))
+# Steps shorter than this (in meters) are merged into the one before...
+COMPACT_MIN_DISTANCE = int(os.getenv('COMPACT_MIN_DISTANCE', '100'))
+# ...as are steps within this many degrees of its heading...
+COMPACT_MAX_HEADING_DELTA = int(os.getenv('COMPACT_MAX_HEADING_DELTA', '20'))
+# ...up to this many steps to a message.
+COMPACT_MAX_MERGE = int(os.getenv('COMPACT_MAX_MERGE', '3'))
+COMPACT_SEPARATOR = u'; '
+
+# Route steps in and messages out of build_steps, for seeing what
+# compaction saves.
+stats = collections.Counter()
+
+_TAG_RE = re.compile(r'<[^>]*>')
+_ENTITY_RE = re.compile(r'&(#[xX]?[0-9a-fA-F]+|\w+);')
+
+
+def heading(start, end):
+    """Compute compass heading between a pair of lat/lon points.
+
+    Based on formulae found at
+    http://www.movable-type.co.uk/scripts/latlong.html.
+    """
+    start_lat = radians(float(start['lat']))
+    end_lat = radians(float(end['lat']))
+    delta_lon = radians(float(end['lng']) - float(start['lng']))
+
+    y = sin(delta_lon) * cos(end_lat)
+    x = ((cos(start_lat) * sin(end_lat)) -
+         (sin(start_lat) * cos(end_lat) * cos(delta_lon)))
+    heading = degrees(atan2(y, x))
+    normalized = (heading + 360) % 360
+    return int(normalized)
+
+
+def headings(starts, ends):
+    """heading() for each pair of points in `starts` and `ends`, in one pass."""
+    if numpy is None or len(starts) < NUMPY_MIN_STEPS:
+        return [heading(start, end) for start, end in izip(starts, ends)]
+
+    start_lat = numpy.radians([float(p['lat']) for p in starts])
+    end_lat = numpy.radians([float(p['lat']) for p in ends])
+    delta_lon = numpy.radians(
+        [float(e['lng']) - float(s['lng']) for s, e in izip(starts, ends)])
+
+    y = numpy.sin(delta_lon) * numpy.cos(end_lat)
+    x = ((numpy.cos(start_lat) * numpy.sin(end_lat)) -
+         (numpy.sin(start_lat) * numpy.cos(end_lat) * numpy.cos(delta_lon)))
+    normalized = (numpy.degrees(numpy.arctan2(y, x)) + 360) % 360
+    return normalized.astype(int).tolist()
+
+
+def _unescape_entity(match):
+    name = match.group(1)
+    if name[0] == '#':
+        if name[1] in 'xX':
+            return unichr(int(name[2:], 16))
+        return unichr(int(name[1:]))
+    codepoint = htmlentitydefs.name2codepoint.get(name)
+    if codepoint is None:
+        return match.group(0)
+    return unichr(codepoint)
+
+
+def strip_tags(html):
+    """Drop the markup from Google's html_instructions, keeping the text."""
+    text = _TAG_RE.sub('', html)
+    if '&' in text:
+        text = _ENTITY_RE.sub(_unescape_entity, text)
+    return text
+
+
+def streetview_url(lat, lon, heading):
+    return STREETVIEW_URL_TMPL.format(lat=str(lat), lon=str(lon), heading=heading)
+
+
+def _heading_delta(a, b):
+    delta = abs(a - b) % 360
+    return min(delta, 360 - delta)
+
+
+def group_steps(distances, bearings,
+                min_distance=COMPACT_MIN_DISTANCE,
+                max_heading_delta=COMPACT_MAX_HEADING_DELTA,
+                max_merge=COMPACT_MAX_MERGE):
+    """Split step indexes into runs that can go out as one message.
+
+    A step joins the run before it if it's shorter than `min_distance`
+    meters or heads within `max_heading_delta` degrees of the run's first
+    step, as long as the run has fewer than `max_merge` steps.
+    """
+    groups = []
+    for idx, (distance, bearing) in enumerate(izip(distances, bearings)):
+        if groups and len(groups[-1]) < max_merge:
+            first = groups[-1][0]
+            if (distance < min_distance or
+                    _heading_delta(bearings[first], bearing) <= max_heading_delta):
+                groups[-1].append(idx)
+                continue
+        groups.append([idx])
+    return groups
+
+
+def build_steps(route_steps, compact=COMPACT_STEPS):
+    """Turn one leg's Directions API steps into the messages we send.
+
+    Returns a list of {'text', 'image', 'lat', 'lon', 'heading'} dicts, one
+    per step plus a final one showing the destination. With `compact`, runs of steps picked
+    by group_steps() share a message, showing the image for the longest.
+    """
+    starts = [item["start_location"] for item in route_steps]
+    ends = [item["end_location"] for item in route_steps]
+    bearings = headings(starts, ends)
+
+    if compact:
+        distances = [item["distance"]["value"] for item in route_steps]
+        groups = group_steps(distances, bearings)
+    else:
+        groups = [[idx] for idx in xrange(len(route_steps))]
+
+    steps = []
+    for number, group in enumerate(groups, 1):
+        if len(group) == 1:
+            idx = group[0]
+            text = strip_tags(route_steps[idx]["html_instructions"])
+        else:
+            idx = max(group, key=lambda i: distances[i])
+            text = COMPACT_SEPARATOR.join(
+                strip_tags(route_steps[i]["html_instructions"]) for i in group)
+        steps.append(_step(u"{}. {}".format(number, text), starts[idx], bearings[idx]))
+    stats['steps_in'] += len(route_steps)
+    stats['steps_out'] += len(groups)
+
+    steps.append(_step(ARRIVAL_MSG, ends[-1], bearings[-1]))
+    return steps
+
+
+def _step(text, point, heading):
+    return {
+        'text': text,
+        'image': streetview_url(point["lat"], point["lng"], heading),
+        'lat': point["lat"],
+        'lon': point["lng"],
+        'heading': heading,
+    }
@@ -0,0 +1,190 @@
+"""Per-user round robin on top of the rq priority queues.
+
+Work is queued per phone number, in a Redis list for each class (high,
+default, low). rq itself only ever holds one runner job per phone number
+per class; each runner does a single piece of that number's work and, if
+there's more, queues a fresh runner at the back of the rq queue. So a user
+with a 60-step route or a thumb on "next" takes turns with everyone else
+instead of filling the queue ahead of them.
+
+Work is stored as JSON naming the function by its import path, so
+arguments must be JSON-serializable. Work that raises is put back at the
+front of its number's line and retried after a backoff, up to MAX_ATTEMPTS
+times, before it's moved to the class's dead-letter list for inspection.
+"""
+import importlib
+import json
+import time
+
+from rq import Queue
+
+import metrics
+from client import LazyScript
+from client import RetryLater
+from worker import conn
+from worker import listen
+
+
+HIGH = 'high'
+DEFAULT = 'default'
+LOW = 'low'
+
+PENDING_KEY_TMPL = "fq:{queue}:pending:{phone_number}"
+ACTIVE_KEY_TMPL = "fq:{queue}:active:{phone_number}"
+DEPTH_KEY_TMPL = "fq:{queue}:depth"
+DEAD_KEY_TMPL = "fq:{queue}:dead"
+COALESCE_KEY_TMPL = "fq:{queue}:coalesce:{phone_number}:{name}"
+# Seconds rq gives a runner before killing it (rq's own default).
+JOB_TIMEOUT = 180
+# A runner that vanishes (say, its worker was killed) only blocks that
+# number's work until its active marker expires. It's refreshed as each
+# runner starts, so this only has to outlast one job, plus some slack.
+ACTIVE_TTL = JOB_TIMEOUT + 60
+# Likewise for work that was coalesced on but never ran.
+COALESCE_TTL = 5 * 60
+# Most a runner waits for work that isn't due yet, if the worker has
+# nothing else to do, so that it doesn't spin on it.
+NOT_DUE_SLEEP_MAX = 1.0
+# Failing work is retried RETRY_BACKOFF seconds later, then four times
+# that, and so on. After MAX_ATTEMPTS tries it goes to the dead-letter
+# list, which keeps the most recent DEAD_MAX items.
+RETRY_BACKOFF = 5
+MAX_ATTEMPTS = 3
+DEAD_MAX = 1000
+
+redis_client = conn
+queues = dict(
+    (name, Queue(name, connection=conn, default_timeout=JOB_TIMEOUT)) for name in listen)
+
+# Take the next piece of work for one phone number, and keep the number
+# active (ARGV[1] seconds) while it runs.
+pop_script = LazyScript("""
+local item = redis.call('LPOP', KEYS[1])
+if item then
+    redis.call('DECR', KEYS[2])
+end
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+return item
+""", lambda: redis_client)
+
+# Called by a runner when it's done: returns 1, keeping the number active,
+# if more work arrived meanwhile, else clears the active marker.
+release_script = LazyScript("""
+if redis.call('LLEN', KEYS[1]) > 0 then
+    redis.call('EXPIRE', KEYS[2], ARGV[1])
+    return 1
+end
+redis.call('DEL', KEYS[2])
+return 0
+""", lambda: redis_client)
+
+
+def enqueue(queue, phone_number, func, *args, **options):
+    """Queue func(*args) as `phone_number`'s next piece of `queue` work.
+
+    With coalesce=<name>, nothing is queued if the number already has work
+    of that name waiting in the same class; once that work starts, new
+    work is queued as usual. Returns whether the work was queued.
+    """
+    coalesce_key = None
+    if options.get('coalesce'):
+        coalesce_key = COALESCE_KEY_TMPL.format(
+            queue=queue, phone_number=phone_number, name=options['coalesce'])
+        if not redis_client.set(coalesce_key, 1, ex=COALESCE_TTL, nx=True):
+            metrics.incr('coalesced_jobs_total', queue=queue)
+            return False
+
+    item = json.dumps({
+        'func': '{}.{}'.format(func.__module__, func.__name__),
+        'args': args,
+        'enqueued': time.time(),
+        'coalesce': coalesce_key,
+    })
+    pipe = redis_client.pipeline()
+    pipe.rpush(PENDING_KEY_TMPL.format(queue=queue, phone_number=phone_number), item)
+    pipe.incr(DEPTH_KEY_TMPL.format(queue=queue))
+    pipe.set(ACTIVE_KEY_TMPL.format(queue=queue, phone_number=phone_number), 1,
+             ex=ACTIVE_TTL, nx=True)
+    _, _, started = pipe.execute()
+    if started:
+        queues[queue].enqueue(run_next, queue, phone_number)
+    return True
+
+
+def run_next(queue, phone_number):
+    """rq job: run one piece of `phone_number`'s work, then yield the worker."""
+    pending_key = PENDING_KEY_TMPL.format(queue=queue, phone_number=phone_number)
+    active_key = ACTIVE_KEY_TMPL.format(queue=queue, phone_number=phone_number)
+
+    item = pop_script(keys=[pending_key, DEPTH_KEY_TMPL.format(queue=queue), active_key],
+                      args=[ACTIVE_TTL])
+    try:
+        if item is not None:
+            item = json.loads(item)
+            wait = item.get('not_before', 0) - time.time()
+            if wait > 0:
+                _put_back(queue, phone_number, item)
+                _idle(wait)
+            else:
+                _run(queue, phone_number, item)
+    finally:
+        if release_script(keys=[pending_key, active_key], args=[ACTIVE_TTL]):
+            queues[queue].enqueue(run_next, queue, phone_number)
+
+
+def _run(queue, phone_number, item):
+    metrics.observe('queue_wait_seconds', time.time() - item['enqueued'], queue=queue)
+    if item.get('coalesce'):
+        # It's too late to fold anything more into this work.
+        redis_client.delete(item['coalesce'])
+    try:
+        _resolve(item['func'])(*item['args'])
+    except RetryLater as e:
+        # Nothing went wrong; say, the sender just has no room yet.
+        item['not_before'] = time.time() + e.retry_after
+        _put_back(queue, phone_number, item)
+        metrics.incr('deferred_jobs_total', queue=queue, reason=type(e).__name__)
+    except Exception as e:
+        item['attempts'] = item.get('attempts', 0) + 1
+        if item['attempts'] < MAX_ATTEMPTS:
+            item['not_before'] = time.time() + RETRY_BACKOFF * 4 ** (item['attempts'] - 1)
+            _put_back(queue, phone_number, item)
+            metrics.incr('retried_jobs_total', queue=queue)
+        else:
+            item['error'] = repr(e)
+            dead_key = DEAD_KEY_TMPL.format(queue=queue)
+            pipe = redis_client.pipeline()
+            pipe.lpush(dead_key, json.dumps(item))
+            pipe.ltrim(dead_key, 0, DEAD_MAX - 1)
+            pipe.execute()
+            metrics.incr('dead_jobs_total', queue=queue)
+        raise
+
+
+def _put_back(queue, phone_number, item):
+    """Return `item` to the front of `phone_number`'s line, for the next runner."""
+    pipe = redis_client.pipeline()
+    pipe.lpush(PENDING_KEY_TMPL.format(queue=queue, phone_number=phone_number), json.dumps(item))
+    pipe.incr(DEPTH_KEY_TMPL.format(queue=queue))
+    if item.get('coalesce'):
+        pipe.set(item['coalesce'], 1, ex=COALESCE_TTL, nx=True)
+    pipe.execute()
+
+
+def _idle(seconds):
+    """Wait up to `seconds` for work to come due, unless there's other work."""
+    if not any(queues[name].count for name in listen):
+        time.sleep(min(seconds, NOT_DUE_SLEEP_MAX))
+
+
+def _resolve(path):
+    module, _, name = path.rpartition('.')
+    return getattr(importlib.import_module(module), name)
+
+
+def depth(queue):
+    return int(redis_client.get(DEPTH_KEY_TMPL.format(queue=queue)) or 0)
+
+
+for _queue in listen:
+    metrics.registry.gauge('queue_depth', lambda queue=_queue: depth(queue), queue=_queue)
@@ -1,26 +1,35 @@
+import functools
 import json
 import logging
 import os
-import re
 import urllib
-from HTMLParser import HTMLParser
-from math import atan2
-from math import cos
-from math import degrees
-from math import radians
-from math import sin
 from urllib import urlencode
 
 import flask
 import redis
-from rq import Queue
+import requests
 from flask import request
 from geopy import geocoders
 
+import directions
+import fairqueue
+import media
+import metrics
+import tiles
+import traffic
 #TODO: XXX replace with twilio-scoped import once we publish the new lib
 import twiml
+from cache import GeocodeCache
+from cache import RouteCache
+from client import LazyScript
+from client import NEXT_PAGE_TMPL
 from client import send_directions_page
-from worker import conn
+from client import send_message
+from client import sender_for
+from directions import DEFAULT_MAPS_PARAMS
+from directions import build_steps
+from router import Router
+from session import Session
 
 
 DEBUG = False
@@ -28,14 +37,27 @@ DEBUG = False
 app = flask.Flask(__name__)
 streamhandler = logging.StreamHandler()
 app.logger.addHandler(streamhandler)
+if media.MEDIA_PROXY_URL:
+    app.register_blueprint(media.blueprint)
 
 geocoder = geocoders.GoogleV3()
 redis_client = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379'))
+geocode_cache = GeocodeCache(geocoder, redis_client)
+route_cache = RouteCache(redis_client)
+metrics.registry.track(lambda: geocode_cache.stats, 'cache_events_total', cache='geocode')
+metrics.registry.track(lambda: route_cache.stats, 'cache_events_total', cache='route')
+metrics.registry.track(lambda: directions.stats, 'compaction_steps_total')
 
-worker_queue = Queue(connection=conn)
+# Replies that never change, rendered once and then served as-is.
+static_responses = twiml.FrozenRegistry()
+
+router = Router()
+
+capture_log = None
+if traffic.TRAFFIC_CAPTURE_PATH:
+    capture_log = traffic.CaptureLog(traffic.TRAFFIC_CAPTURE_PATH)
 
 STATIC_MAPS_URI = 'https://maps.googleapis.com/maps/api/staticmap'
-DEFAULT_MAPS_PARAMS = {'sensor': 'false', 'size': '640x640'}
 
 DEFAULT_ZOOM = '15'
 
@@ -78,7 +100,6 @@ LON_PAN_DISTANCE_MAP = {
 }
 
 GMAPS_DIRECTIONS_URI = 'http://maps.googleapis.com/maps/api/directions/json'
-STREETVIEW_URI = 'http://maps.googleapis.com/maps/api/streetview'
 
 
 class TConDirections(object):
@@ -99,9 +120,6 @@ KEYWORD_TO_TCON = {
     'tcon': TConDirections.TCON,
 }
 
-TCONDIRS_OR = '|'.join(KEYWORD_TO_TCON.keys())
-TCONDIRS_RE = re.compile('^{}$'.format(TCONDIRS_OR), re.IGNORECASE)
-
 
 class Directions(object):
     NORTH = 'north'
@@ -125,10 +143,19 @@ KEYWORD_TO_DIRECTION = {
     'out': Directions.OUT,
 }
 
-DIRECTIONS_OR = '|'.join(KEYWORD_TO_DIRECTION.keys())
-DIRECTIONS_RE = re.compile('^{}$'.format(DIRECTIONS_OR), re.IGNORECASE)
-
-DESTINATION_RE = re.compile('^to:', re.IGNORECASE)
+# Snap map centers to Web Mercator tile centers and pan a whole tile at a
+# time, so everyone looking at the same neighbourhood gets the same (and
+# so cacheable) map URL.
+MAP_TILE_GRID = bool(os.getenv('MAP_TILE_GRID'))
+
+DIRECTION_TO_TILE_MOVE = {
+    Directions.NORTH: dict(dy=-1),
+    Directions.SOUTH: dict(dy=1),
+    Directions.EAST: dict(dx=1),
+    Directions.WEST: dict(dx=-1),
+    Directions.IN: dict(dzoom=1),
+    Directions.OUT: dict(dzoom=-1),
+}
 
 HELP_STRING = u"""Send a location ("645 Harrison Street, San Francisco, CA") to get a map image in reply.
 
@@ -137,94 +164,209 @@ Navigate the map with directions, e.g. "north" or "out".
 To get street directions: "To: 635 8th Street, San Francisco, CA"
 """
 
-HELP_RE = re.compile('^help|usage', re.IGNORECASE)
-
 PAGE_SIZE = 3
-STEPS_KEY_TMPL = "steps:{phone_number}"
+
+# Look up directions in an rq job instead of on the webhook thread.
+ASYNC_DIRECTIONS = bool(os.getenv('ASYNC_DIRECTIONS'))
+DIRECTIONS_ERROR = u"Sorry, we couldn't find directions to that destination."
+# Answer "To: ..." with the first page of directions in the webhook reply
+# itself, leaving only later pages to the worker. With ASYNC_DIRECTIONS
+# this only happens when the route is already cached.
+INLINE_FIRST_PAGE = bool(os.getenv('INLINE_FIRST_PAGE'))
+
+# After sending a map, warm the media cache with the views one move away.
+# Needs the media proxy, and a worker that shares its cache directory.
+MAP_PREFETCH = bool(os.getenv('MAP_PREFETCH'))
+# Most images prefetched per PREFETCH_WINDOW seconds, per user and overall.
+PREFETCH_USER_BUDGET = int(os.getenv('PREFETCH_USER_BUDGET', '30'))
+PREFETCH_GLOBAL_BUDGET = int(os.getenv('PREFETCH_GLOBAL_BUDGET', '600'))
+PREFETCH_WINDOW = 60
+PREFETCH_USER_KEY_TMPL = "prefetch:{phone_number}"
+PREFETCH_GLOBAL_KEY = "prefetch:all"
 
 
 @app.route('/', methods=['POST'])
 def handle_request():
-    phone_number = request.form['From']
-    body = request.form['Body']
-
-    location = _get_stored_location(phone_number)
-
-    # Handle all of our special case logic for TwilioCon
-    # If you're grabbing the source, you can either change those
-    # or remove them entirely
-    preset = _parse_twiliocon_presets(body)
-    nav_cmd = _parse_navigation(body)
-
-    if preset is not None:
-        response = _get_tcon_response(preset)
-        return unicode(response)
-    elif body.lower() == 'next':
-        _send_next_page(phone_number, PAGE_SIZE)
-        response = twiml.Response()
-        return unicode(response)
-
-    elif nav_cmd is not None:
-        if location:
-            location = _apply_movement(location, nav_cmd)
-        else:
-            return _error(u"Please enter a location to start from!")
-    elif DESTINATION_RE.match(body):
-        # OK, get them some directions.
-        destination = re.sub(DESTINATION_RE, '', body)
-        # XXX use destination with current location place to get directions
-        if (not location):
-            return _error(u"Please provide a starting location first.")
+    if capture_log is not None:
+        capture_log.record(request.form['From'], request.form['Body'])
+
+    handler, argument = router.route(request.form['Body'])
+    with metrics.timer('webhook_seconds', command=handler.__name__[len('_handle_'):]):
+        with metrics.timer('stage_seconds', stage='session_load'):
+            session = Session(
+                redis_client,
+                request.form['From'],
+                request.form.get('MessageSid'),
+                request.form.get('To'),
+            ).load()
+        if session.duplicate:
+            # Twilio retried, or the message arrived twice: answer the same
+            # way without doing the work again.
+            metrics.incr('duplicate_messages_total')
+            return session.previous_reply or unicode(twiml.Response())
+        try:
+            reply = handler(session, argument)
+        except Exception:
+            session.release()
+            raise
         else:
-            # XXX store steps and enqueue first page
-            steps = get_steps(location["place"], destination)
-            _store_steps(phone_number, steps)
-            _send_next_page(phone_number, PAGE_SIZE)
-            return unicode(twiml.Response())
-    elif HELP_RE.match(body):
-        return _usage()
-
+            session.set_reply(reply)
+            return reply
+        finally:
+            with metrics.timer('stage_seconds', stage='session_flush'):
+                session.flush()
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return flask.Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Handle all of our special case logic for TwilioCon
+# If you're grabbing the source, you can either change those
+# or remove them entirely
+@router.keywords(KEYWORD_TO_TCON)
+def _handle_preset(session, preset):
+    return static_responses.get(preset).data
+
+
+@router.keywords({'next': None})
+def _handle_next(session, _):
+    if session.steps_remaining:
+        _send_next_page(session.phone_number, PAGE_SIZE, fairqueue.DEFAULT)
+    return unicode(twiml.Response())
+
+
+# Since a location string might contain a directional word, these only
+# match when they're the *whole* message.
+@router.keywords(KEYWORD_TO_DIRECTION)
+def _handle_navigation(session, direction):
+    if not session.location:
+        return _error(u"Please enter a location to start from!")
+    return _show_map(session, _apply_movement(session.location, direction))
+
+
+@router.prefix('to:')
+def _handle_destination(session, destination):
+    # OK, get them some directions.
+    location = session.location
+    if (not location):
+        return _error(u"Please provide a starting location first.")
+    elif ASYNC_DIRECTIONS:
+        if INLINE_FIRST_PAGE:
+            with metrics.timer('stage_seconds', stage='route_cache'):
+                steps = route_cache.get(location["place"], destination)
+            if steps is not None:
+                return _inline_first_page(session, steps)
+        with metrics.timer('stage_seconds', stage='enqueue'):
+            fairqueue.enqueue(
+                fairqueue.HIGH,
+                session.phone_number,
+                fetch_directions,
+                session.phone_number,
+                location["place"],
+                destination,
+                PAGE_SIZE,
+            )
+        return unicode(twiml.Response())
     else:
-        # Just show the location requested.
-        try:
-            place, (lat, lon) = geocoder.geocode(body)
-        except ValueError:
-            return _error(u"Sorry, we couldn't find a unique match for that location.")
-        location = dict(place=place, lat=lat, lon=lon, zoom=DEFAULT_ZOOM)
+        steps = get_steps(location["place"], destination)
+        if INLINE_FIRST_PAGE:
+            return _inline_first_page(session, steps)
+        session.set_steps(steps)
+        # The page job reads the steps back, so write them first.
+        session.flush()
+        _send_next_page(session.phone_number, PAGE_SIZE, fairqueue.HIGH)
+        return unicode(twiml.Response())
+
+
+def _inline_first_page(session, steps):
+    """Reply with the first page of `steps`, leaving the rest for "next"."""
+    session.set_steps(steps, cursor=PAGE_SIZE)
+    page = steps[:PAGE_SIZE]
+    metrics.incr('messages_inlined_total', len(page))
+
+    with metrics.timer('stage_seconds', stage='render'):
+        r = twiml.Response()
+        for idx, step in enumerate(page):
+            text = step['text']
+            if idx == len(page) - 1 and session.steps_remaining:
+                text = NEXT_PAGE_TMPL.format(text)
+            r.message(msg=text).media(media.proxy_url(step['image']))
+        return unicode(r)
+
+
+@router.prefix('help', 'usage')
+def _handle_help(session, _):
+    return _usage()
+
+
+@router.default
+def _handle_location(session, body):
+    # Just show the location requested.
+    try:
+        with metrics.timer('stage_seconds', stage='geocode'):
+            place, (lat, lon) = geocode_cache.geocode(body)
+    except ValueError:
+        return _error(u"Sorry, we couldn't find a unique match for that location.")
+    location = dict(place=place, lat=lat, lon=lon, zoom=DEFAULT_ZOOM)
+    if MAP_TILE_GRID:
+        lat, lon = tiles.snap(lat, lon, int(DEFAULT_ZOOM))
+        location.update(_grid_location(lat, lon, int(DEFAULT_ZOOM)))
+    return _show_map(session, location)
+
+
+def _show_map(session, location):
+    session.set_location(location)
+    if MAP_PREFETCH and media.media_cache is not None:
+        with metrics.timer('stage_seconds', stage='enqueue'):
+            fairqueue.enqueue(
+                fairqueue.LOW, session.phone_number,
+                prefetch_neighbors, session.phone_number, location)
+    with metrics.timer('stage_seconds', stage='render'):
+        return unicode(_build_map_response(location))
+
+
+def _error_response(message):
+    response = twiml.Response()
+    response.message(msg=message)
+    return response
 
 
-    response = _build_map_response(location)
-    _store_location(phone_number, location)
+ERROR_TEMPLATE = twiml.ResponseTemplate(_error_response)
 
-    return unicode(response)
 
+def _error(message):
+    return ERROR_TEMPLATE.render(message)
 
 
-def _error(message):
+@static_responses.register('usage')
+def _usage_response():
     response = twiml.Response()
-    response.message(msg=message)
-    return unicode(response)
+    response.message(msg=HELP_STRING)
+    return response
 
 
 def _usage():
-    response = twiml.Response()
-    response.message(msg=HELP_STRING)
-    return unicode(response)
+    return static_responses.get('usage').data
 
 
-def _build_map_response(location):
+def _map_url(location):
     map_params = {
         'center': '{},{}'.format(str(location['lat']), str(location['lon'])),
         'zoom': location['zoom'],
     }
     map_params.update(DEFAULT_MAPS_PARAMS)
-    map_tile_url = '{}?{}'.format(
+    return '{}?{}'.format(
         STATIC_MAPS_URI,
         urlencode(map_params),
     )
+
+
+def _build_map_response(location):
     r = twiml.Response()
     msg = r.message()
-    msg.media(map_tile_url)
+    msg.media(media.proxy_url(_map_url(location)))
 
     return r
 
@@ -236,111 +378,123 @@ def get_directions(orig, dest):
     return '{}?{}'.format(GMAPS_DIRECTIONS_URI, encoded)
 
 
-def _heading(start, end):
-    """Compute compass heading between a pair of lat/lon points.
-
-    Based on formulae found at
-    http://www.movable-type.co.uk/scripts/latlong.html.
-    """
-    start_lat = radians(float(start['lat']))
-    end_lat = radians(float(end['lat']))
-    delta_lon = radians(float(end['lng']) - float(start['lng']))
-
-    y = sin(delta_lon) * cos(end_lat)
-    x = ((cos(start_lat) * sin(end_lat)) -
-         (sin(start_lat) * cos(end_lat) * cos(delta_lon)))
-    heading = degrees(atan2(y, x))
-    normalized = (heading + 360) % 360
-    return int(normalized)
+def get_steps(orig, dest):
+    with metrics.timer('stage_seconds', stage='route_cache'):
+        steps = route_cache.get(orig, dest)
+    if steps is None:
+        with metrics.timer('stage_seconds', stage='directions'):
+            steps = _fetch_steps(orig, dest)
+        route_cache.set(orig, dest, steps)
+    return steps
 
 
-def get_steps(orig, dest):
+def _fetch_steps(orig, dest):
     # connect to google api json
     decodeme = get_directions(orig, dest)
     app.logger.info("requesting directions at {}".format(decodeme))
 
-    googleResponse = urllib.urlopen(decodeme)
-    jsonResponse = json.loads(googleResponse.read())
-    steps = []
-    for idx, item in enumerate(jsonResponse["routes"][0]["legs"][0]["steps"]):
-        lat = item["start_location"]["lat"]
-        lon = item["start_location"]["lng"]
-        heading = _heading(item["start_location"], item["end_location"])
-        instructions = u"{}. {}".format(
-            idx + 1,
-            strip_tags(item["html_instructions"]),
-        )
-
-        params = {
-            'location': '{},{}'.format(str(lat), str(lon)),
-            'heading': str(heading),
-        }
-        params.update(DEFAULT_MAPS_PARAMS)
-
-        streetview_url = '{}?{}'.format(STREETVIEW_URI, urlencode(params))
-        steps.append({'text': instructions, 'image': streetview_url})
-
-    end = jsonResponse["routes"][0]["legs"][0]["steps"][-1]["end_location"]
-    params = {
-        'location': '{},{}'.format(str(end["lat"]), str(end["lng"])),
-        'heading': str(heading),
-    }
-    params.update(DEFAULT_MAPS_PARAMS)
+    try:
+        googleResponse = urllib.urlopen(decodeme)
+        jsonResponse = json.loads(googleResponse.read())
+        route_steps = jsonResponse["routes"][0]["legs"][0]["steps"]
+    except (IOError, ValueError, KeyError, IndexError):
+        metrics.incr('upstream_errors_total', service='directions')
+        raise
+    return build_steps(route_steps)
 
-    streetview_url = '{}?{}'.format(STREETVIEW_URI, urlencode(params))
-    arrival_msg = u"Hopefully you ended up somewhere looking sort of like this."
-    steps.append({'text': arrival_msg, 'image': streetview_url})
-
-    return steps
 
+def fetch_directions(phone_number, orig, dest, page_size):
+    """rq job: look up directions, store them and queue the first page.
 
-def _get_stored_location(phone_number):
-    return redis_client.hgetall(phone_number)
-
+    Failures are reported to the user by SMS, since the webhook has already
+    returned by the time this runs.
+    """
+    try:
+        steps = get_steps(orig, dest)
+    except (IOError, ValueError, KeyError, IndexError):
+        app.logger.exception(
+            "directions lookup failed: {!r} -> {!r}".format(orig, dest))
+        send_message(phone_number, sender_for(phone_number), body=DIRECTIONS_ERROR)
+        return
 
-def _store_location(phone_number, location_dict):
-    redis_client.hmset(
-        phone_number,
-        location_dict,
-    )
-    redis_client.expire(phone_number, REDIS_EXPIRATION)
+    _store_steps(phone_number, steps)
+    _send_next_page(phone_number, page_size, fairqueue.HIGH)
 
 
 def _store_steps(phone_number, steps):
-    encoded_steps = [json.dumps(step) for step in steps]
-    key = STEPS_KEY_TMPL.format(phone_number=phone_number)
-
-    # Nuke anything that was there before.
-    redis_client.delete(key)
-
-    redis_client.rpush(key, *encoded_steps)
-    redis_client.expire(key, REDIS_EXPIRATION)
-
+    session = Session(redis_client, phone_number)
+    session.set_steps(steps)
+    session.flush()
 
-def _send_next_page(phone_number, page_size):
-    worker_queue.enqueue(send_directions_page, phone_number, page_size)
 
-
-def _parse_twiliocon_presets(body):
-    if TCONDIRS_RE.match(body):
-        print "body.lower: {}".format(body.lower())
+def prefetch_neighbors(phone_number, location):
+    """rq job: fetch the map images for every view one move away from `location`."""
+    urls = []
+    for direction in set(KEYWORD_TO_DIRECTION.values()):
+        try:
+            neighbor = _apply_movement(location, direction)
+        except KeyError:
+            # Zoomed past the end of the pan distance tables.
+            continue
+        url = _map_url(neighbor)
+        if not media.media_cache.contains(url):
+            urls.append(url)
+
+    for url in urls[:_claim_prefetch_budget(phone_number, len(urls))]:
+        try:
+            media.media_cache.get(url)
+        except (requests.RequestException, media.UpstreamError):
+            app.logger.warning("prefetch failed for {}".format(url))
 
 
-        # Since a location string might contain a directional word,
-        # require an *exact* match against one of our commands.
-        return KEYWORD_TO_TCON[body.lower()]
+def _claim_prefetch_budget(phone_number, wanted):
+    """Reserve up to `wanted` prefetches; return how many we may make."""
+    if not wanted:
+        return 0
 
-    print "No keywords matched from body: {}".format(body)
-    return None
+    return claim_prefetch_script(
+        keys=[PREFETCH_USER_KEY_TMPL.format(phone_number=phone_number), PREFETCH_GLOBAL_KEY],
+        args=[wanted, PREFETCH_USER_BUDGET, PREFETCH_GLOBAL_BUDGET, PREFETCH_WINDOW],
+    )
 
 
-def _parse_navigation(body):
-    if DIRECTIONS_RE.match(body):
-        # Since a location string might contain a directional word,
-        # require an *exact* match against one of our commands.
-        return KEYWORD_TO_DIRECTION[body.lower()]
+# Grant up to ARGV[1] prefetches against the user (KEYS[1]) and global
+# (KEYS[2]) budgets of ARGV[2] and ARGV[3], counting only what's granted.
+# A window starts with its first grant and lasts ARGV[4] seconds; a
+# counter found without a TTL gets one, so it can't stick for good.
+claim_prefetch_script = LazyScript("""
+local wanted = tonumber(ARGV[1])
+local user_used = tonumber(redis.call('GET', KEYS[1]) or '0')
+local global_used = tonumber(redis.call('GET', KEYS[2]) or '0')
+local granted = math.max(0, math.min(
+    wanted, tonumber(ARGV[2]) - user_used, tonumber(ARGV[3]) - global_used))
+if granted > 0 then
+    for _, key in ipairs(KEYS) do
+        redis.call('INCRBY', key, granted)
+        if redis.call('TTL', key) < 0 then
+            redis.call('EXPIRE', key, ARGV[4])
+        end
+    end
+end
+return granted
+""", lambda: redis_client)
+
+
+def _send_next_page(phone_number, page_size, queue):
+    """Queue a page of steps: the first on HIGH, later ones on DEFAULT.
+
+    A "next" that arrives while a page is still waiting to go out is folded
+    into it rather than queueing a second page. Only pages of the same
+    class are folded together, so a new route's first page never waits
+    behind a "next". Runners in different classes can still overlap, but
+    only one of them can lease the recipient's page at a time; the other
+    gets PageBusy and is retried once the page is given up.
+    """
+    with metrics.timer('stage_seconds', stage='enqueue'):
+        fairqueue.enqueue(
+            queue, phone_number, send_directions_page, phone_number, page_size,
+            coalesce='page')
 
-    return None
 
 def _get_tcon_response(command):
 
@@ -395,10 +549,37 @@ def _get_tcon_response(command):
     return r
 
 
+for _command in set(KEYWORD_TO_TCON.values()):
+    static_responses.register(_command, functools.partial(_get_tcon_response, _command))
+
+
 
 
 
+def _grid_location(lat, lon, zoom):
+    # Fixed precision, so the same tile always renders the same URL.
+    return dict(lat='{:.6f}'.format(lat), lon='{:.6f}'.format(lon), zoom=str(zoom))
+
+
+def _apply_tile_movement(location, direction):
+    try:
+        move = DIRECTION_TO_TILE_MOVE[direction]
+    except KeyError:
+        raise ValueError("Unknown direction {}".format(direction))
+
+    lat, lon, zoom = tiles.move(
+        float(location['lat']),
+        float(location['lon']),
+        int(location['zoom']),
+        **move
+    )
+    return _grid_location(lat, lon, zoom)
+
+
 def _apply_movement(location, direction):
+    if MAP_TILE_GRID:
+        return _apply_tile_movement(location, direction)
+
     lat, lon = float(location['lat']), float(location['lon'])
     zoom = int(location['zoom'])
     if direction is Directions.NORTH:
@@ -429,26 +610,6 @@ def _apply_movement(location, direction):
     return dict(lat=str(lat), lon=str(lon), zoom=str(zoom))
 
 
-# HTMLParser subclass to strip all tags out of text.
-# Taken from http://stackoverflow.com/a/925630
-class MLStripper(HTMLParser):
-    def __init__(self):
-        self.reset()
-        self.fed = []
-
-    def handle_data(self, d):
-        self.fed.append(d)
-
-    def get_data(self):
-        return ''.join(self.fed)
-
-
-def strip_tags(html):
-    s = MLStripper()
-    s.feed(html)
-    return s.get_data()
-
-
 if __name__ == '__main__':
     app.debug = True
     DEBUG = True
@@ -0,0 +1,231 @@
+"""Optional caching proxy for the map and Street View images we send.
+
+With MEDIA_PROXY_URL set, the image URLs in our messages point at this
+app's /media endpoint instead of at Google. The first request for an image
+fetches it upstream and files it in a content-addressed on-disk cache, and
+later requests are served straight from disk.
+"""
+import errno
+import hashlib
+import os
+import tempfile
+from urllib import urlencode
+
+import flask
+import requests
+
+
+# Public base URL Twilio should fetch proxied media from, e.g.
+# https://dradis.herokuapp.com. The proxy is off when this isn't set.
+MEDIA_PROXY_URL = os.getenv('MEDIA_PROXY_URL')
+MEDIA_CACHE_DIR = os.getenv(
+    'MEDIA_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'dradis-media'),
+)
+MEDIA_CACHE_MAX_BYTES = int(os.getenv('MEDIA_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+MEDIA_MAX_AGE = 7 * 24 * 60 * 60
+MEDIA_FETCH_TIMEOUT = 10
+
+# Eviction frees space down to this fraction of the limit, so we don't
+# rescan the cache on every new image once it's full.
+EVICT_TO = 0.9
+
+ALLOWED_UPSTREAMS = (
+    'http://maps.googleapis.com/maps/api/',
+    'https://maps.googleapis.com/maps/api/',
+)
+
+
+class UpstreamError(Exception):
+    pass
+
+
+def proxy_url(url):
+    """The URL Twilio should fetch `url` through, or `url` if the proxy is off."""
+    if not MEDIA_PROXY_URL:
+        return url
+    return '{}/media?{}'.format(MEDIA_PROXY_URL.rstrip('/'), urlencode({'u': url}))
+
+
+_upstream_session = requests.Session()
+
+
+def fetch_upstream(url):
+    """Default fetcher: return (content_type, content) for `url`."""
+    res = _upstream_session.get(url, timeout=MEDIA_FETCH_TIMEOUT)
+    if res.status_code != 200:
+        raise UpstreamError("Error fetching {}: {}".format(url, res.status_code))
+    return res.headers.get('Content-Type', 'application/octet-stream'), res.content
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        return False
+    return True
+
+
+def _stat_disk_size(stat):
+    # Blocks actually allocated: a 60 byte index file still takes a block.
+    return getattr(stat, 'st_blocks', 0) * 512 or stat.st_size
+
+
+def _disk_size(path):
+    return _stat_disk_size(os.stat(path))
+
+
+class MediaCache(object):
+    """Size-bounded, content-addressed image cache on local disk.
+
+    Image bytes live under objects/ named by their SHA-1, so identical
+    images fetched through different URLs are stored once. Small files
+    under urls/ map each upstream URL to its object and content type. Both
+    count towards `max_bytes`, by the disk space they take up. Hits touch
+    the mtimes of both, and eviction removes the least recently used files
+    first.
+
+    `fetcher` is called as fetcher(url) -> (content_type, content) on a
+    miss. Swap it out to fetch from somewhere other than Google.
+    """
+
+    def __init__(self, root, max_bytes, fetcher=fetch_upstream):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.fetcher = fetcher
+        self.objects_dir = os.path.join(root, 'objects')
+        self.urls_dir = os.path.join(root, 'urls')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        for path in (self.objects_dir, self.urls_dir, self.tmp_dir):
+            _makedirs(path)
+        self._size = self._scan_size()
+
+    def get(self, url):
+        """Return (path, content_type, digest), fetching `url` if needed."""
+        entry = self._lookup(url)
+        if entry is not None:
+            return entry
+        return self._store(url, *self.fetcher(url))
+
+    def contains(self, url):
+        return self._lookup(url) is not None
+
+    def _lookup(self, url):
+        url_path = self._url_path(url)
+        try:
+            with open(url_path) as f:
+                digest, content_type = f.read().split('\n', 1)
+        except IOError:
+            return None
+
+        path = self._object_path(digest)
+        try:
+            os.utime(path, None)
+            os.utime(url_path, None)
+        except OSError:
+            # Evicted since the URL was indexed; drop the stale index entry.
+            _unlink(url_path)
+            return None
+        return path, content_type, digest
+
+    def _store(self, url, content_type, content):
+        digest = hashlib.sha1(content).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            self._write(path, content)
+            self._size += _disk_size(path)
+        url_path = self._url_path(url)
+        if not os.path.exists(url_path):
+            self._write(url_path, '{}\n{}'.format(digest, content_type))
+            self._size += _disk_size(url_path)
+
+        if self._size > self.max_bytes:
+            self._evict()
+        return path, content_type, digest
+
+    def _write(self, path, data):
+        # Write then rename, so readers in other workers never see half a file.
+        _makedirs(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def _files(self):
+        """(mtime, disk size, path) for every object and URL index file."""
+        for top in (self.objects_dir, self.urls_dir):
+            for dirpath, _, filenames in os.walk(top):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield stat.st_mtime, _stat_disk_size(stat), path
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._files())
+
+    def _evict(self):
+        files = sorted(self._files())
+        size = sum(size for _, size, _ in files)
+        target = self.max_bytes * EVICT_TO
+        for _, file_size, path in files:
+            if size <= target:
+                break
+            if _unlink(path):
+                size -= file_size
+        self._size = size
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _url_path(self, url):
+        digest = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.urls_dir, digest[:2], digest)
+
+
+media_cache = None
+if MEDIA_PROXY_URL:
+    media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES)
+
+blueprint = flask.Blueprint('media', __name__)
+
+
+@blueprint.route('/media')
+def serve_media():
+    url = flask.request.args.get('u', '').encode('utf-8')
+    if not url.startswith(ALLOWED_UPSTREAMS):
+        flask.abort(404)
+
+    for _ in xrange(2):
+        try:
+            path, content_type, digest = media_cache.get(url)
+        except (requests.RequestException, UpstreamError):
+            flask.abort(502)
+
+        # send_file hands the open file to the server's wsgi.file_wrapper,
+        # which gunicorn serves with sendfile().
+        try:
+            response = flask.send_file(
+                path,
+                mimetype=content_type,
+                add_etags=False,
+                cache_timeout=MEDIA_MAX_AGE,
+            )
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Evicted since get() found it; get() will fetch it again.
+            continue
+        response.set_etag(digest)
+        return response.make_conditional(flask.request)
+    flask.abort(404)
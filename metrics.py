@@ -0,0 +1,233 @@
+"""Counters and latency histograms, shared across processes through Redis.
+
+Each process keeps its own deltas in memory and a background thread adds
+them into one Redis hash every METRICS_FLUSH_INTERVAL seconds, so
+recording a metric never costs a round trip. The /metrics endpoint renders the hash in Prometheus
+text format. Set METRICS_LOCAL to keep everything in process instead, e.g.
+for a single process or the benchmarks.
+"""
+import atexit
+import collections
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import redis
+
+
+METRICS_KEY = "metrics"
+METRICS_PREFIX = 'dradis_'
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '10'))
+METRICS_LOCAL = bool(os.getenv('METRICS_LOCAL'))
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Hash fields are "<type>|<name>|<labels>|<suffix>", e.g.
+# 'h|stage_seconds|stage="geocode"|0.05' for one histogram bucket.
+_SEP = '|'
+
+
+def _labels(labels):
+    return ','.join('{}="{}"'.format(k, labels[k]) for k in sorted(labels))
+
+
+class Registry(object):
+
+    def __init__(self, redis_client=None, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.redis_client = redis_client
+        self.flush_interval = flush_interval
+        self._pending = collections.Counter()
+        self._totals = collections.Counter()
+        self._tracked = []
+        self._gauges = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._flusher_pid = None
+        self._closed = threading.Event()
+
+    def incr(self, name, amount=1, **labels):
+        self._add('c' + _SEP + name + _SEP + _labels(labels) + _SEP, amount)
+
+    def observe(self, name, seconds, **labels):
+        field = 'h' + _SEP + name + _SEP + _labels(labels) + _SEP
+        index = bisect_left(BUCKETS, seconds)
+        bucket = repr(BUCKETS[index]) if index < len(BUCKETS) else '+Inf'
+        with self._lock:
+            self._pending[field + bucket] += 1
+            self._pending[field + 'count'] += 1
+            self._pending[field + 'sum'] += seconds
+        self._ensure_flusher()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def track(self, source, name, **labels):
+        """Export a collections.Counter, one `event` label per key.
+
+        For objects like GeocodeCache.stats that already count for
+        themselves. `source` returns the Counter; whatever it has gained
+        is picked up on each flush.
+        """
+        self._tracked.append((source, name, labels, collections.Counter()))
+
+    def gauge(self, name, source, **labels):
+        """Report whatever `source()` returns each time metrics are rendered.
+
+        For values that already live somewhere shared, like a queue depth
+        kept in Redis, so there is nothing to aggregate.
+        """
+        self._gauges.append((name, _labels(labels), source))
+
+    def _add(self, field, amount):
+        with self._lock:
+            self._pending[field] += amount
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        # The first metric in each process starts a thread to flush on the
+        # interval, so a worker that goes idle still gets its last ones out.
+        # Threads don't survive a fork, hence the pid.
+        if self.redis_client is not None and self._flusher_pid != os.getpid():
+            self._start_flusher()
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        self._flusher = threading.Thread(target=self._flush_periodically, name='metrics-flush')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.getLogger(__name__).exception("couldn't flush metrics")
+
+    def _collect_tracked(self):
+        for source, name, labels, seen in self._tracked:
+            for event, value in source().items():
+                delta = value - seen[event]
+                if delta < 0:
+                    # A fresh Counter replaced the one we were watching.
+                    delta = value
+                if delta:
+                    seen[event] = value
+                    self.incr(name, delta, event=event, **labels)
+
+    def close(self):
+        """Stop the flush thread, and flush whatever's left."""
+        self._closed.set()
+        if self._flusher is not None and self._flusher.is_alive():
+            self._flusher.join()
+        self.flush()
+
+    def flush(self):
+        """Push this process's deltas into the shared hash."""
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        self._collect_tracked()
+        with self._lock:
+            pending, self._pending = self._pending, collections.Counter()
+
+        if self.redis_client is None:
+            self._totals.update(pending)
+            return
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for field, amount in pending.iteritems():
+            if isinstance(amount, float):
+                pipe.hincrbyfloat(METRICS_KEY, field, amount)
+            else:
+                pipe.hincrby(METRICS_KEY, field, amount)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            # Put them back for next time rather than lose them.
+            with self._lock:
+                self._pending.update(pending)
+
+    def totals(self):
+        if self.redis_client is None:
+            return dict(self._totals)
+        return dict(
+            (field, float(value))
+            for field, value in self.redis_client.hgetall(METRICS_KEY).iteritems()
+        )
+
+    def render(self):
+        """Everything recorded so far, in Prometheus text format."""
+        self.flush()
+        counters = collections.defaultdict(dict)
+        histograms = collections.defaultdict(lambda: collections.defaultdict(dict))
+        for field, value in self.totals().iteritems():
+            kind, name, labels, suffix = field.split(_SEP, 3)
+            if kind == 'c':
+                counters[name][labels] = value
+            else:
+                histograms[name][labels][suffix] = value
+
+        lines = []
+        gauges = collections.defaultdict(list)
+        for name, labels, source in self._gauges:
+            gauges[name].append((labels, source()))
+        for name in sorted(gauges):
+            lines.append('# TYPE {}{} gauge'.format(METRICS_PREFIX, name))
+            for labels, value in sorted(gauges[name]):
+                lines.append(_sample(name, labels, value))
+        for name in sorted(counters):
+            lines.append('# TYPE {}{} counter'.format(METRICS_PREFIX, name))
+            for labels, value in sorted(counters[name].iteritems()):
+                lines.append(_sample(name, labels, value))
+        for name in sorted(histograms):
+            lines.append('# TYPE {}{} histogram'.format(METRICS_PREFIX, name))
+            for labels, values in sorted(histograms[name].iteritems()):
+                cumulative = 0
+                for bound in BUCKETS:
+                    cumulative += values.get(repr(bound), 0)
+                    lines.append(_sample(name + '_bucket', _with_le(labels, repr(bound)), cumulative))
+                lines.append(_sample(name + '_bucket', _with_le(labels, '+Inf'), values.get('count', 0)))
+                lines.append(_sample(name + '_sum', labels, values.get('sum', 0)))
+                lines.append(_sample(name + '_count', labels, values.get('count', 0)))
+        return '\n'.join(lines) + '\n'
+
+
+def _with_le(labels, bound):
+    le = 'le="{}"'.format(bound)
+    return '{},{}'.format(labels, le) if labels else le
+
+
+def _sample(name, labels, value):
+    value = '{:d}'.format(int(value)) if value == int(value) else repr(value)
+    if labels:
+        return '{}{}{{{}}} {}'.format(METRICS_PREFIX, name, labels, value)
+    return '{}{} {}'.format(METRICS_PREFIX, name, value)
+
+
+def _build_registry():
+    if METRICS_LOCAL:
+        return Registry()
+    return Registry(redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379')))
+
+
+registry = _build_registry()
+# Whatever's left when a process exits normally, e.g. a gunicorn worker
+# being recycled.
+atexit.register(registry.close)
+incr = registry.incr
+observe = registry.observe
+timer = registry.timer
@@ -0,0 +1,79 @@
+"""Packing a route's steps into one compact string for Redis.
+
+Only what differs from step to step is kept: the instruction text, where
+the Street View image is taken from and which way it faces. Image URLs are
+rebuilt from those at send time.
+
+Layout, all little-endian:
+
+    header   B version, H step count
+    index    I offset of each record from the first, plus one for the end
+    records  i lat, i lon (millionths of a degree), H heading, utf-8 text
+
+A page of steps can be read with two GETRANGEs of the index and records,
+without fetching or decoding the rest of the route.
+"""
+import struct
+from itertools import izip
+
+VERSION = 1
+HEADER = struct.Struct('<BH')
+OFFSET = struct.Struct('<I')
+RECORD = struct.Struct('<iiH')
+
+
+def encode(steps):
+    """Pack steps, which need text, lat, lon and heading, into one string."""
+    records = []
+    offsets = [0]
+    for step in steps:
+        record = RECORD.pack(
+            int(round(float(step['lat']) * 1e6)),
+            int(round(float(step['lon']) * 1e6)),
+            int(step['heading']) % 360,
+        ) + step['text'].encode('utf-8')
+        records.append(record)
+        offsets.append(offsets[-1] + len(record))
+
+    return ''.join([
+        HEADER.pack(VERSION, len(steps)),
+        struct.pack('<{}I'.format(len(offsets)), *offsets),
+    ] + records)
+
+
+def count(header):
+    """The number of steps in a route, given at least its header."""
+    if len(header) < HEADER.size:
+        return 0
+    version, length = HEADER.unpack_from(header)
+    if version != VERSION:
+        raise ValueError("Unknown route encoding version {}".format(version))
+    return length
+
+
+def decode_page(index, records):
+    """Decode consecutive steps from their slice of the index and records.
+
+    `index` holds one more offset than there are steps, and `records` starts
+    at the first of them.
+    """
+    offsets = struct.unpack('<{}I'.format(len(index) // OFFSET.size), index)
+    base = offsets[0] if offsets else 0
+    steps = []
+    for start, end in izip(offsets, offsets[1:]):
+        start, end = start - base, end - base
+        lat, lon, heading = RECORD.unpack_from(records, start)
+        steps.append({
+            'text': records[start + RECORD.size:end].decode('utf-8'),
+            'lat': lat / 1e6,
+            'lon': lon / 1e6,
+            'heading': heading,
+        })
+    return steps
+
+
+def decode(blob):
+    """Decode a whole route."""
+    length = count(blob)
+    index_end = HEADER.size + (length + 1) * OFFSET.size
+    return decode_page(blob[HEADER.size:index_end], blob[index_end:])
@@ -0,0 +1,77 @@
+"""Dispatch inbound message bodies to command handlers in a single pass."""
+
+# Marks a trie node that ends a registered prefix.
+_HANDLER = object()
+
+
+class Router(object):
+    """Maps message bodies onto handler functions.
+
+    Keyword commands must match the whole (trimmed, case-folded) body and
+    are found with a single dict lookup. Prefix commands such as "to: ..."
+    are found by walking a character trie along the start of the body.
+    Anything else goes to the default handler.
+    """
+
+    def __init__(self):
+        self._keywords = {}
+        self._trie = {}
+        self._default = None
+
+    def keywords(self, table):
+        """Decorator routing every key in `table` to the handler.
+
+        The handler is called with the key's value as its argument.
+        """
+        def register(handler):
+            for keyword, value in table.iteritems():
+                keyword = keyword.lower()
+                if keyword in self._keywords:
+                    raise ValueError("Keyword {} is already routed".format(keyword))
+                self._keywords[keyword] = (handler, value)
+            return handler
+        return register
+
+    def prefix(self, *prefixes):
+        """Decorator routing bodies that start with any of `prefixes`.
+
+        The handler is called with the rest of the body as its argument. The
+        longest matching prefix wins.
+        """
+        def register(handler):
+            for prefix in prefixes:
+                node = self._trie
+                for char in prefix.lower():
+                    node = node.setdefault(char, {})
+                if _HANDLER in node:
+                    raise ValueError("Prefix {} is already routed".format(prefix))
+                node[_HANDLER] = handler
+            return handler
+        return register
+
+    def default(self, handler):
+        """Decorator routing everything else to the handler, with the body."""
+        self._default = handler
+        return handler
+
+    def route(self, body):
+        """Return (handler, argument) for `body`."""
+        stripped = body.strip()
+        folded = stripped.lower()
+
+        match = self._keywords.get(folded)
+        if match is not None:
+            return match
+
+        node = self._trie
+        handler, length = None, 0
+        for idx, char in enumerate(folded):
+            node = node.get(char)
+            if node is None:
+                break
+            if _HANDLER in node:
+                handler, length = node[_HANDLER], idx + 1
+
+        if handler is not None:
+            return handler, stripped[length:]
+        return self._default, body
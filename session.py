@@ -0,0 +1,412 @@
+"""Per-phone-number state kept in Redis between webhook requests.
+
+Layout (schema v1, see client.SESSION_PREFIX):
+
+    s:v1:loc:<bucket>       hash: phone number -> packed location
+    s:v1:place:<bucket>     hash: phone number -> place the location was looked up from
+    s:v1:cur:<bucket>       hash: phone number -> paging cursor (and lease)
+    s:v1:steps:<number>     the route being paged through, packed by routeblob
+
+Numbers are spread over SESSION_BUCKETS hashes, so each stays under
+hash-max-ziplist-entries and is stored in Redis's compact encoding, at a
+fraction of the memory of a key per number. Fields can't expire on their
+own, so locations carry the time they were written and older ones are
+ignored; a place goes with its location. They're deleted when found on
+load, and a write sweeps its bucket now and then (SESSION_SWEEP_CHANCE),
+since a bucket that's still written to never expires as a whole. Routes
+are too big to gain anything from a hash, so they stay a key per number.
+`python session.py sweep` does every bucket, and `python session.py
+report` estimates what sessions cost.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import redis
+
+import client
+import routeblob
+from client import CURSOR_KEY_TMPL
+from client import LOCATION_KEY_TMPL
+from client import PLACE_KEY_TMPL
+from client import REDIS_EXPIRATION
+from client import SESSION_BUCKETS
+from client import SENDER_KEY_TMPL
+from client import SESSION_PREFIX
+from client import STEPS_KEY_TMPL
+from client import TWILIO_SENDERS
+from client import session_bucket
+
+REPLY_KEY_TMPL = "reply:{message_sid}"
+# Twilio gives up on a webhook long before this.
+REPLY_TTL = 10 * 60
+# Stored under a reply key while the first delivery is still being handled.
+REPLY_PENDING = ''
+# Rough bytes Redis spends on a key before its value: the dict entries
+# (with the TTL), object header and key string header.
+KEY_OVERHEAD = 64
+# Odds that writing a location also sweeps its bucket.
+SESSION_SWEEP_CHANCE = float(os.getenv('SESSION_SWEEP_CHANCE', '0.01'))
+
+# A packed location is "<written at>|<zoom>|<lat>|<lon>", around 40 bytes.
+# Keep it short: values over hash-max-ziplist-value bytes (64 by default)
+# push their whole bucket out of the compact encoding, which is why the
+# place, an address of any length, is kept in hashes of its own. Those
+# are left to fall back to Redis's regular encoding when they must.
+LOCATION_FIELDS = ('zoom', 'lat', 'lon')
+SEP = '|'
+
+
+def pack_location(location, now=None):
+    values = [str(int(now or time.time()))]
+    for field in LOCATION_FIELDS:
+        value = location.get(field, '')
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        values.append(value if isinstance(value, str) else str(value))
+    return SEP.join(values)
+
+
+def unpack_location(packed, now=None):
+    """The location in `packed`, or {} if there is none or it's expired."""
+    if not packed:
+        return {}
+    values = packed.split(SEP, len(LOCATION_FIELDS))
+    if (now or time.time()) - int(values[0]) > REDIS_EXPIRATION:
+        return {}
+    return dict(
+        (field, value)
+        for field, value in zip(LOCATION_FIELDS, values[1:])
+        if value
+    )
+
+
+class Session(object):
+    """Everything we keep in Redis for one phone number.
+
+    load() reads it all in one pipelined round trip. The set_* methods only
+    record changes, and flush() writes them back, refreshing TTLs, in one
+    more.
+
+    Given the Twilio MessageSid, load() also claims the message, so a
+    redelivery of it is marked `duplicate` and carries the reply we gave
+    the first time (None if that's still being worked out).
+
+    Given the number the message was sent to, load() also makes it the
+    one we send to this phone number from (see client.sender_for), since
+    that's where TwiML replies come from and where the user will write
+    next.
+    """
+
+    def __init__(self, redis_client, phone_number, message_sid=None, inbound=None):
+        self.redis_client = redis_client
+        self.phone_number = phone_number
+        self.message_sid = message_sid
+        # With a single sender there's no choice to remember.
+        self.inbound = inbound if len(TWILIO_SENDERS) > 1 and inbound in TWILIO_SENDERS else None
+        self.bucket = session_bucket(phone_number)
+        self.location = {}
+        self.steps_remaining = 0
+        self.duplicate = False
+        self.previous_reply = None
+
+        self._location_changed = False
+        self._location_expired = False
+        self._steps = None
+        self._cursor = 0
+        self._reply = None
+        self._release = False
+
+    @property
+    def location_key(self):
+        return LOCATION_KEY_TMPL.format(bucket=self.bucket)
+
+    @property
+    def place_key(self):
+        return PLACE_KEY_TMPL.format(bucket=self.bucket)
+
+    @property
+    def steps_key(self):
+        return STEPS_KEY_TMPL.format(phone_number=self.phone_number)
+
+    @property
+    def cursor_key(self):
+        return CURSOR_KEY_TMPL.format(bucket=self.bucket)
+
+    @property
+    def reply_key(self):
+        return REPLY_KEY_TMPL.format(message_sid=self.message_sid)
+
+    @property
+    def sender_key(self):
+        return SENDER_KEY_TMPL.format(recipient=self.phone_number)
+
+    def load(self):
+        pipe = self.redis_client.pipeline()
+        pipe.hget(self.location_key, self.phone_number)
+        pipe.getrange(self.steps_key, 0, routeblob.HEADER.size - 1)
+        pipe.hget(self.cursor_key, self.phone_number)
+        pipe.hget(self.place_key, self.phone_number)
+        if self.message_sid:
+            pipe.set(self.reply_key, REPLY_PENDING, ex=REPLY_TTL, nx=True)
+            pipe.get(self.reply_key)
+        if self.inbound:
+            # Before any job queued for this message picks a sender.
+            pipe.setex(name=self.sender_key, value=self.inbound, time=REDIS_EXPIRATION)
+        results = pipe.execute()
+        location, steps_header, cursor, place = results[:4]
+
+        self.location = unpack_location(location)
+        if self.location and place:
+            self.location['place'] = place
+        # Clear it out on the way past, rather than wait for a sweep.
+        self._location_expired = bool(location) and not self.location
+        cursor = int((cursor or '0').split('|', 1)[0])
+        self.steps_remaining = max(routeblob.count(steps_header) - cursor, 0)
+        if self.message_sid and not results[4]:
+            self.duplicate = True
+            self.previous_reply = results[5] or None
+        return self
+
+    def set_location(self, location):
+        """Merge `location` into the stored location, like HMSET does."""
+        self.location.update(location)
+        self._location_changed = True
+
+    def set_steps(self, steps, cursor=0):
+        """Replace the stored steps and page from `cursor` (the start by default)."""
+        self._steps = steps
+        self._cursor = cursor
+        self.steps_remaining = max(len(steps) - cursor, 0)
+
+    def set_reply(self, reply):
+        """Keep `reply` to answer any redelivery of this message with."""
+        if self.message_sid:
+            self._reply = reply.encode('utf-8') if isinstance(reply, unicode) else reply
+
+    def release(self):
+        """Give up our claim on the message, so a redelivery is handled afresh."""
+        if self.message_sid:
+            self._release = True
+
+    def flush(self):
+        if (not self._location_changed and not self._location_expired and
+                self._steps is None and self._reply is None and not self._release):
+            return
+
+        pipe = self.redis_client.pipeline()
+        if self._location_changed:
+            pipe.hset(self.location_key, self.phone_number, pack_location(self.location))
+            pipe.expire(self.location_key, REDIS_EXPIRATION)
+            # Rewritten with the location, so neither outlives the other.
+            place = self.location.get('place')
+            if place:
+                pipe.hset(
+                    self.place_key,
+                    self.phone_number,
+                    place.encode('utf-8') if isinstance(place, unicode) else place,
+                )
+                pipe.expire(self.place_key, REDIS_EXPIRATION)
+            else:
+                pipe.hdel(self.place_key, self.phone_number)
+        elif self._location_expired:
+            pipe.hdel(self.location_key, self.phone_number)
+            pipe.hdel(self.place_key, self.phone_number)
+
+        if self._steps is not None:
+            # Nuke anything that was there before, including how far we'd got.
+            pipe.delete(self.steps_key)
+            pipe.hdel(self.cursor_key, self.phone_number)
+            if self._steps:
+                pipe.setex(
+                    name=self.steps_key,
+                    value=routeblob.encode(self._steps),
+                    time=REDIS_EXPIRATION,
+                )
+            if self._cursor:
+                pipe.hset(self.cursor_key, self.phone_number, self._cursor)
+                pipe.expire(self.cursor_key, REDIS_EXPIRATION)
+
+        if self._reply is not None:
+            pipe.setex(name=self.reply_key, value=self._reply, time=REPLY_TTL)
+        elif self._release:
+            pipe.delete(self.reply_key)
+
+        pipe.execute()
+        if self._location_changed and random.random() < SESSION_SWEEP_CHANCE:
+            sweep_bucket(self.redis_client, self.bucket)
+        self._location_changed = False
+        self._location_expired = False
+        self._steps = None
+        self._reply = None
+        self._release = False
+
+
+def _buckets(template):
+    return [template.format(bucket=bucket) for bucket in xrange(SESSION_BUCKETS)]
+
+
+def sweep_bucket(redis_client, bucket, now=None):
+    """Delete one bucket's expired locations, places without a location,
+    and cursors whose route has expired.
+
+    Returns how many fields were removed.
+    """
+    removed = 0
+    key = LOCATION_KEY_TMPL.format(bucket=bucket)
+    live = set()
+    stale = []
+    for number, packed in redis_client.hgetall(key).iteritems():
+        if unpack_location(packed, now):
+            live.add(number)
+        else:
+            stale.append(number)
+    if stale:
+        removed += redis_client.hdel(key, *stale)
+
+    key = PLACE_KEY_TMPL.format(bucket=bucket)
+    stale = [number for number in redis_client.hkeys(key) if number not in live]
+    if stale:
+        removed += redis_client.hdel(key, *stale)
+
+    key = CURSOR_KEY_TMPL.format(bucket=bucket)
+    numbers = redis_client.hkeys(key)
+    if numbers:
+        pipe = redis_client.pipeline(transaction=False)
+        for number in numbers:
+            pipe.exists(STEPS_KEY_TMPL.format(phone_number=number))
+        stale = [number for number, exists in zip(numbers, pipe.execute()) if not exists]
+        if stale:
+            removed += redis_client.hdel(key, *stale)
+    return removed
+
+
+def sweep(redis_client, now=None):
+    """sweep_bucket() every bucket; returns how many fields were removed."""
+    now = now or time.time()
+    return sum(sweep_bucket(redis_client, bucket, now) for bucket in xrange(SESSION_BUCKETS))
+
+
+def _memory_usage(redis_client, key):
+    """Bytes used by `key`: exact where MEMORY USAGE exists, else estimated."""
+    try:
+        return int(redis_client.execute_command('MEMORY', 'USAGE', key) or 0)
+    except redis.ResponseError:
+        # Older servers: the serialized size plus the per-key overhead.
+        info = redis_client.debug_object(key)
+        return int(info['serializedlength']) + KEY_OVERHEAD + len(key)
+
+
+def _summarize_buckets(redis_client, template):
+    keys = _buckets(template)
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hlen(key)
+    lengths = pipe.execute()
+
+    total_bytes = 0
+    encodings = {}
+    for key, length in zip(keys, lengths):
+        if not length:
+            continue
+        total_bytes += _memory_usage(redis_client, key)
+        encoding = redis_client.object('encoding', key)
+        encodings[encoding] = encodings.get(encoding, 0) + 1
+    return sum(lengths), max(lengths or [0]), total_bytes, encodings
+
+
+def _sample_keys(redis_client, samples, templates):
+    """Estimate the number and total size of keys from each template by sampling.
+
+    Returns a (count, bytes) pair per template, in order.
+    """
+    prefixes = [template.format(phone_number='') for template in templates]
+    seen = 0
+    sizes = [[] for _ in prefixes]
+    for _ in xrange(samples):
+        key = redis_client.randomkey()
+        if key is None:
+            break
+        seen += 1
+        for prefix, found in zip(prefixes, sizes):
+            if key.startswith(prefix):
+                found.append(_memory_usage(redis_client, key))
+    estimates = []
+    for found in sizes:
+        if not found:
+            estimates.append((0, 0))
+            continue
+        count = redis_client.dbsize() * len(found) / float(seen)
+        estimates.append((int(count), count * sum(found) / len(found)))
+    return estimates
+
+
+def report(redis_client, users, samples=1000, out=sys.stdout):
+    """Print what sessions cost now, and what `users` sessions would."""
+    sessions, loc_max, loc_bytes, loc_encodings = _summarize_buckets(
+        redis_client, LOCATION_KEY_TMPL)
+    places, place_max, place_bytes, place_encodings = _summarize_buckets(
+        redis_client, PLACE_KEY_TMPL)
+    cursors, cur_max, cur_bytes, cur_encodings = _summarize_buckets(
+        redis_client, CURSOR_KEY_TMPL)
+    [(routes, route_bytes)] = _sample_keys(redis_client, samples, [STEPS_KEY_TMPL])
+    used_memory = int(redis_client.info('memory')['used_memory'])
+    max_entries = int(redis_client.config_get('hash-max-ziplist-entries').values()[0])
+
+    out.write('schema {}  buckets {}\n'.format(SESSION_PREFIX.rstrip(':'), SESSION_BUCKETS))
+    out.write('used_memory {:,} B\n\n'.format(used_memory))
+    for name, count, biggest, size, encodings in [
+            ('locations', sessions, loc_max, loc_bytes, loc_encodings),
+            ('places', places, place_max, place_bytes, place_encodings),
+            ('cursors', cursors, cur_max, cur_bytes, cur_encodings)]:
+        out.write('{:<10} {:>9,} entries  {:>13,} B  largest bucket {:,}  {}\n'.format(
+            name, count, size, biggest,
+            ', '.join('{} {}'.format(n, e) for e, n in sorted(encodings.items()))))
+    out.write('{:<10} {:>9,} (est.)   {:>13,.0f} B\n\n'.format('routes', routes, route_bytes))
+
+    if not sessions:
+        out.write('no active sessions to project from\n')
+        return
+
+    bucketed = float(loc_bytes + place_bytes + cur_bytes) / sessions
+    per_key = route_bytes / sessions
+    # Routes are the one thing left that costs a key per number.
+    key_overhead = routes * (KEY_OVERHEAD + len(STEPS_KEY_TMPL.format(phone_number='+10000000000')))
+    out.write('{:,.0f} B per active session: {:,.0f} B in buckets, {:,.0f} B in per-number '
+              'route keys ({:,.0f} B of it key overhead)\n'.format(
+                  bucketed + per_key, bucketed, per_key, key_overhead / sessions))
+    out.write('{:,} users: ~{:,.1f} MB\n'.format(users, (bucketed + per_key) * users / 2 ** 20))
+    needed = -(-users // max_entries)
+    if needed > SESSION_BUCKETS:
+        out.write('raise SESSION_BUCKETS to at least {:,} to keep buckets under '
+                  'hash-max-ziplist-entries ({})\n'.format(needed, max_entries))
+    # Place buckets may leave the compact encoding for a long address.
+    for encodings in (loc_encodings, cur_encodings):
+        if set(encodings) - set(['ziplist', 'listpack']):
+            out.write('some buckets have left the compact encoding; check '
+                      'hash-max-ziplist-entries/-value\n')
+            break
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Session storage maintenance.")
+    commands = parser.add_subparsers(dest='command')
+    report_parser = commands.add_parser('report', help="estimate session memory use")
+    report_parser.add_argument('--users', type=int, default=100000,
+                               help="project memory use to this many users (default: %(default)s)")
+    report_parser.add_argument('--samples', type=int, default=1000,
+                               help="random keys to sample for route sizes (default: %(default)s)")
+    commands.add_parser('sweep', help="delete expired locations and cursors")
+    args = parser.parse_args(argv)
+
+    if args.command == 'report':
+        report(client.redis_client, args.users, args.samples)
+    else:
+        print 'removed {} expired fields'.format(sweep(client.redis_client))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""Web Mercator tile arithmetic, for snapping map views onto a shared grid.
+
+Tiles are numbered the way Google's (and everyone else's) slippy maps do:
+at zoom z there are 2**z x 2**z tiles, x growing eastwards from the
+antimeridian and y growing southwards from the top of the projection.
+"""
+from math import atan
+from math import cos
+from math import degrees
+from math import log
+from math import pi
+from math import radians
+from math import sinh
+from math import tan
+
+MIN_ZOOM = 0
+MAX_ZOOM = 21
+MAX_LATITUDE = 85.0511287798
+
+
+def clamp_zoom(zoom):
+    return max(MIN_ZOOM, min(MAX_ZOOM, zoom))
+
+
+def tile_for(lat, lon, zoom):
+    """Return the (x, y) of the tile containing lat/lon at `zoom`."""
+    n = 2 ** zoom
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    lat_rad = radians(lat)
+
+    x = int((lon + 180.0) / 360.0 * n) % n
+    y = int((1.0 - log(tan(lat_rad) + 1.0 / cos(lat_rad)) / pi) / 2.0 * n)
+    return x, max(0, min(n - 1, y))
+
+
+def tile_center(x, y, zoom):
+    """Return the (lat, lon) at the middle of tile (x, y)."""
+    n = 2 ** zoom
+    lon = (x + 0.5) / n * 360.0 - 180.0
+    lat = degrees(atan(sinh(pi * (1.0 - 2.0 * (y + 0.5) / n))))
+    return lat, lon
+
+
+def snap(lat, lon, zoom):
+    """Move lat/lon to the center of the tile it falls in."""
+    return tile_center(*(tile_for(lat, lon, zoom) + (zoom,)))
+
+
+def move(lat, lon, zoom, dx=0, dy=0, dzoom=0):
+    """Step from the tile under lat/lon to a neighbour, parent or child.
+
+    dx/dy move that many whole tiles east/south (negative for west/north),
+    wrapping around the antimeridian. dzoom=1 moves to the child tile that
+    contains lat/lon and dzoom=-1 to the parent. Returns (lat, lon, zoom)
+    for the center of the new tile.
+    """
+    new_zoom = clamp_zoom(zoom + dzoom)
+    x, y = tile_for(lat, lon, new_zoom)
+
+    n = 2 ** new_zoom
+    x = (x + dx) % n
+    y = max(0, min(n - 1, y + dy))
+
+    lat, lon = tile_center(x, y, new_zoom)
+    return lat, lon, new_zoom
@@ -0,0 +1,91 @@
+"""Recording inbound webhook traffic, for replay with bench.replay."""
+import errno
+import hashlib
+import hmac
+import json
+import os
+import time
+
+
+# Where to append captured requests. Capture is off when this isn't set.
+TRAFFIC_CAPTURE_PATH = os.getenv('TRAFFIC_CAPTURE_PATH')
+# Keyed into the phone number hash. Without a secret, anonymized numbers
+# could be reversed by hashing every possible number, so if this isn't
+# set a random one is made and kept next to the log (see capture_salt).
+TRAFFIC_CAPTURE_SALT = os.getenv('TRAFFIC_CAPTURE_SALT')
+
+
+def anonymize(phone_number, salt):
+    """Stable stand-in for `phone_number`, so sessions still line up."""
+    digest = hmac.new(salt, phone_number.encode('utf-8'), hashlib.sha1).hexdigest()
+    return 'anon:{}'.format(digest[:16])
+
+
+def capture_salt(path):
+    """The salt for the capture log at `path`: read from `path`.salt, or made.
+
+    The salt file is only readable by its owner and shouldn't leave the
+    box with the log. Every worker ends up with the same salt, and so the
+    same stand-ins, even if several start at once: a new salt is written
+    to a file of its own and then linked into place, which fails if
+    another worker got there first.
+    """
+    salt_path = path + '.salt'
+    try:
+        with open(salt_path) as f:
+            return f.read()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    salt = os.urandom(16).encode('hex')
+    tmp_path = '{}.{}'.format(salt_path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    try:
+        os.write(fd, salt)
+    finally:
+        os.close(fd)
+    try:
+        os.link(tmp_path, salt_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        with open(salt_path) as f:
+            salt = f.read()
+    finally:
+        os.unlink(tmp_path)
+    return salt
+
+
+class CaptureLog(object):
+    """Appends one JSON line per inbound message: ts, from, body.
+
+    Each line goes out in a single write() on an O_APPEND descriptor, so
+    several gunicorn workers can share one file. `salt` defaults to
+    TRAFFIC_CAPTURE_SALT, or else capture_salt(path).
+    """
+
+    def __init__(self, path, salt=TRAFFIC_CAPTURE_SALT):
+        self.path = path
+        self.salt = salt
+        self._fd = None
+
+    def record(self, phone_number, body):
+        if self._fd is None:
+            if not self.salt:
+                self.salt = capture_salt(self.path)
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        line = json.dumps({
+            'ts': time.time(),
+            'from': anonymize(phone_number, self.salt),
+            'body': body,
+        })
+        os.write(self._fd, line + '\n')
+
+
+def read_log(path):
+    """Return the records in a capture log, oldest first."""
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda record: record['ts'])
+    return records
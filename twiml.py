@@ -5,36 +5,101 @@ import xml.etree.ElementTree as ET
 from six import iteritems
 
 
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>'
+HTTP_METHODS = frozenset(["GET", "POST"])
+
+
 class TwimlException(Exception):
     pass
 
 
+def _escape_cdata(text):
+    """Escape element text exactly as ElementTree.tostring does."""
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text.encode("us-ascii", "xmlcharrefreplace")
+
+
+def _escape_attrib(text):
+    """Escape an attribute value exactly as ElementTree.tostring does."""
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    if "\"" in text:
+        text = text.replace("\"", "&quot;")
+    if "\n" in text:
+        text = text.replace("\n", "&#10;")
+    return text.encode("us-ascii", "xmlcharrefreplace")
+
+
+class VerbType(type):
+    """Metaclass for verbs.
+
+    Gives each verb class empty ``__slots__`` unless it declares its own, an
+    interned tag ``name``, and a frozenset of the tags in ``nestables``.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        attrs.setdefault('__slots__', ())
+        attrs['name'] = intern(name)
+        cls = super(VerbType, mcs).__new__(mcs, name, bases, attrs)
+        cls.nestable_names = frozenset(cls.nestables or ())
+        return cls
+
+
 class Verb(object):
     """Twilio basic verb object.
     """
+    __metaclass__ = VerbType
+    __slots__ = ('body', '_verbs', '_attrs')
+
     GET = "GET"
     POST = "POST"
     nestables = None
 
     def __init__(self, **kwargs):
-        self.name = self.__class__.__name__
         self.body = None
-        self.verbs = []
-        self.attrs = {}
+        self._verbs = None
+        self._attrs = None
+
+        if not kwargs:
+            return
 
-        if kwargs.get("waitMethod", "GET") not in ["GET", "POST"]:
+        if kwargs.get("waitMethod", "GET") not in HTTP_METHODS:
             raise TwimlException("Invalid waitMethod parameter, "
                                  "must be 'GET' or 'POST'")
 
-        if kwargs.get("method", "GET") not in ["GET", "POST"]:
+        if kwargs.get("method", "GET") not in HTTP_METHODS:
             raise TwimlException("Invalid method parameter, "
                                  "must be 'GET' or 'POST'")
 
-        for k, v in kwargs.items():
+        attrs = {}
+        for k, v in iteritems(kwargs):
             if k == "sender":
                 k = "from"
             if v is not None:
-                self.attrs[k] = v
+                attrs[k] = v
+        if attrs:
+            self._attrs = attrs
+
+    @property
+    def verbs(self):
+        if self._verbs is None:
+            self._verbs = []
+        return self._verbs
+
+    @property
+    def attrs(self):
+        if self._attrs is None:
+            self._attrs = {}
+        return self._attrs
 
     def __str__(self):
         return self.toxml()
@@ -52,13 +117,53 @@ class Verb(object):
         :param bool xml_declaration: Include the XML declaration. Defaults to
                                      True
         """
+        buf = []
+        self.write(buf.append)
+        xml = ''.join(buf).decode('utf-8')
+
+        if xml_declaration:
+            return XML_DECLARATION + xml
+        else:
+            return xml
+
+    def toxml_etree(self, xml_declaration=True):
+        """
+        Same as :meth:`toxml`, but rendered by building an ElementTree first.
+
+        Slower; kept to check the output of :meth:`toxml` against.
+        """
         xml = ET.tostring(self.xml()).decode('utf-8')
 
         if xml_declaration:
-            return '<?xml version="1.0" encoding="UTF-8"?>' + xml
+            return XML_DECLARATION + xml
         else:
             return xml
 
+    def write(self, write):
+        """Serialize this verb by passing chunks of XML to `write`."""
+        write("<" + self.name)
+
+        attrs = self._attrs
+        if attrs:
+            for a in sorted(attrs):
+                value = attrs[a]
+
+                if isinstance(value, bool):
+                    value = str(value).lower()
+                else:
+                    value = str(value)
+                write(' %s="%s"' % (a, _escape_attrib(value)))
+
+        if self.body or self._verbs:
+            write(">")
+            if self.body:
+                write(_escape_cdata(self.body))
+            for verb in self._verbs or ():
+                verb.write(write)
+            write("</" + self.name + ">")
+        else:
+            write(" />")
+
     def xml(self):
         el = ET.Element(self.name)
 
@@ -81,13 +186,80 @@ class Verb(object):
         return el
 
     def append(self, verb):
-        if not self.nestables or verb.name not in self.nestables:
+        if verb.name not in self.nestable_names:
             raise TwimlException("%s is not nestable inside %s" %
                                  (verb.name, self.name))
-        self.verbs.append(verb)
+        if self._verbs is None:
+            self._verbs = [verb]
+        else:
+            self._verbs.append(verb)
         return verb
 
 
+class FrozenResponse(object):
+    """A verb tree rendered once, for replies that never change."""
+
+    def __init__(self, verb):
+        self.xml = verb.toxml()
+        self.data = self.xml.encode('utf-8')
+
+    def __unicode__(self):
+        return self.xml
+
+    def __str__(self):
+        return self.data
+
+
+class ResponseTemplate(object):
+    """A verb tree rendered once around a single text slot.
+
+    `build` is called with a placeholder and must return a verb tree that
+    uses it as the text of exactly one element. :meth:`render` then only has
+    to escape the value and splice it in.
+    """
+    SLOT = '\x00slot\x00'
+
+    def __init__(self, build):
+        xml = build(self.SLOT).toxml()
+        parts = xml.split(self.SLOT)
+        if len(parts) != 2:
+            raise TwimlException("Template must use its slot exactly once")
+        self.prefix, self.suffix = parts
+
+    def render(self, text):
+        return self.prefix + _escape_cdata(text).decode('ascii') + self.suffix
+
+
+class FrozenRegistry(object):
+    """Named :class:`FrozenResponse` objects, each rendered on first use."""
+
+    def __init__(self):
+        self._builders = {}
+        self._frozen = {}
+
+    def register(self, name, build=None):
+        """Register `build`, a function returning a verb tree, under `name`.
+
+        Can be used as a decorator.
+        """
+        if build is None:
+            return lambda build: self.register(name, build)
+        if name in self._builders:
+            raise TwimlException("%s is already registered" % name)
+        self._builders[name] = build
+        return build
+
+    def __contains__(self, name):
+        return name in self._builders
+
+    def get(self, name):
+        try:
+            return self._frozen[name]
+        except KeyError:
+            frozen = self._frozen[name] = FrozenResponse(self._builders[name]())
+            return frozen
+
+
 class Response(Verb):
     """Twilio response object."""
     nestables = [
@@ -3,12 +3,40 @@ import os
 import redis
 from rq import Worker, Queue, Connection
 
+import metrics
+
 
 listen = ['high', 'default', 'low']
 redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
 conn = redis.from_url(redis_url)
 
+# Set WORKER_FORK to get rq's default fork-per-job behaviour back.
+WORKER_FORK = bool(os.getenv('WORKER_FORK'))
+
+
+class MetricsWorker(Worker):
+    """Flushes metrics after every job, so none are lost when a child exits."""
+
+    def perform_job(self, job):
+        try:
+            return super(MetricsWorker, self).perform_job(job)
+        finally:
+            metrics.registry.flush()
+
+
+class PersistentWorker(MetricsWorker):
+    """Runs each job in the worker process instead of a forked child.
+
+    Module-level state such as client.http_session then lives as long as
+    the worker, so keep-alive connections are reused from job to job.
+    """
+
+    def fork_and_perform_job(self, job):
+        self.perform_job(job)
+
+
 if __name__ == '__main__':
+    worker_class = MetricsWorker if WORKER_FORK else PersistentWorker
     with Connection(conn):
-        worker = Worker(map(Queue, listen))
+        worker = worker_class(map(Queue, listen))
         worker.work()